@@ -3,8 +3,9 @@
 # outputs: 
 #     - data/processed/substances.parquet - Parquet file containing processed substance data with SELFIES, encoded SELFIES, InChI, and SMILES.
 #     - data/processed/selfies_tokenizer.json - JSON file containing the trained SELFIES tokenizer for encoding and decoding SELFIES strings.
+#     - data/processed/selfies_truncation.json - SELFIES token length percentiles and how many molecules are truncated at PAD_LENGTH.
 #     - data/processed/activities.parquet - Parquet file containing processed activity data with assay IDs, substance IDs, binary values, and Morgan fingerprints, ready for conversion to a TensorDataset.
-import biobricks
+import biobricks, json
 import pyspark.sql, pyspark.sql.functions as F, pyspark.ml.feature
 import cvae.tokenizer.selfies_tokenizer, cvae.utils, cvae.spark_helpers as H
 
@@ -16,6 +17,9 @@ spark = pyspark.sql.SparkSession.builder \
     .config("spark.executor.memory", "64g") \
     .getOrCreate()
 
+# encoded selfies length, including sos and eos. it is recorded in the tokenizer, batches are trimmed to their longest molecule in training
+PAD_LENGTH = 120
+
 # GET CHEMHARMONY SUBSTANCES ===============================================================
 chemharmony = biobricks.assets('chemharmony')
 rawsubstances = spark.read.parquet(chemharmony.substances_parquet).select("sid","source","data")
@@ -37,11 +41,16 @@ substances = substances.select('sid', 'inchi', 'smiles', 'selfies').distinct()
 substances = substances.filter(substances.selfies.isNotNull())
 
 # Transform selfies to indices
-tokenizer = cvae.tokenizer.selfies_tokenizer.SelfiesTokenizer().fit(substances, 'selfies')
-substances = tokenizer.transform(substances, 'selfies', 'encoded_selfies')
+tokenizer = cvae.tokenizer.selfies_tokenizer.SelfiesTokenizer(pad_length=PAD_LENGTH).fit(substances, 'selfies')
+substances = tokenizer.transform(substances, 'selfies', 'encoded_selfies', length_column='selfies_length')
+
+truncation = tokenizer.truncation_stats(substances, 'selfies_length')
+print(f"{truncation['truncated']} of {truncation['molecules']} selfies ({100*truncation['truncated_fraction']:.3f}%) truncated at {PAD_LENGTH} tokens, longest {truncation['max_length']}")
+with open('data/processed/selfies_truncation.json', 'w') as file:
+    json.dump(truncation, file, indent=2)
 
 tokenizer.save('data/processed/selfies_tokenizer.json')
-substances.write.parquet('data/processed/substances.parquet', mode='overwrite')
+substances.drop('selfies_length').write.parquet('data/processed/substances.parquet', mode='overwrite')
 
 spark.read.parquet('data/processed/substances.parquet').count() # 115 153 470
 spark.read.parquet('data/processed/substances.parquet').show(100)
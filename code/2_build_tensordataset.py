@@ -1,6 +1,7 @@
 import uuid, torch, torch.nn.utils.rnn
 import pyspark.sql, pyspark.sql.functions as F
 import cvae.utils, cvae.tokenizer.selfies_tokenizer, cvae.tokenizer.selfies_property_val_tokenizer
+import cvae.models.multitask_transformer as mt
 
 spark = pyspark.sql.SparkSession.builder \
     .appName("ChemharmonyDataProcessing") \
@@ -35,12 +36,15 @@ def build_multitask_supervised_data(spark):
 
     tokenizer.save(cvae.utils.mk_empty_directory('brick/selfies_property_val_tokenizer', overwrite=True))
 
+    # assay values are stored CSR style, concatenated with row offsets, instead of padded to the partition's longest row
+    dtype = mt.token_dtype(tokenizer.vocab_size)
     def create_tensors(partition, outdir):
         partition = list(partition)
-        selfies = torch.stack([torch.LongTensor(r.encoded_selfies) for r in partition])
+        selfies = torch.stack([torch.LongTensor(r.encoded_selfies) for r in partition]).to(dtype)
         assay_vals = [tokenizer.tokenize_assay_values(r.assay_val_pairs) for r in partition]
-        assay_vals = torch.nn.utils.rnn.pad_sequence(assay_vals, batch_first=True, padding_value=tokenizer.pad_idx)
-        torch.save({'selfies': selfies, 'assay_vals': assay_vals}, (outdir / f"{uuid.uuid4()}.pt").as_posix())
+        assay_val_offsets = torch.cumsum(torch.LongTensor([0] + [len(row) for row in assay_vals]), dim=0)
+        torch.save({'selfies': selfies, 'assay_vals': torch.cat(assay_vals).to(dtype), 'assay_val_offsets': assay_val_offsets},
+                   (outdir / f"{uuid.uuid4()}.pt").as_posix())
 
     gdata = data \
         .select("encoded_selfies", "assay_index", "value").distinct() \
@@ -53,6 +57,9 @@ def build_multitask_supervised_data(spark):
         outdir = cvae.utils.mk_empty_directory(f'data/tensordataset/multitask_tensors/{path}', overwrite=True)
         df.foreachPartition(lambda partition: create_tensors(partition, outdir))
         
+        # flat memory mapped copy of the split for mt.TokenStoreDataset, shared by dataloader workers without copies
+        mt.write_token_store(outdir, f'data/tensordataset/multitask_tokens/{path}', tokenizer)
+        
 build_multitask_supervised_data(spark)
 
 # BUILD SINGLE TASK SUPERVISED DATA SET =============================================
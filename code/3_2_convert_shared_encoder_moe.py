@@ -0,0 +1,40 @@
+# purpose: convert the brick/moe mixture of experts into a SharedEncoderMoE that encodes the selfies once for all experts.
+# the shared model is initialized from the moe checkpoint and then fine tuned by distillation against the original moe.
+# dependencies: brick/moe, data/tensordataset/multitask_tensors
+# outputs:
+#     - brick/moe_shared - SharedEncoderMoE checkpoint, loaded with cvae.models.mixture_experts.SharedEncoderMoE.load
+import sys, os
+sys.path.insert(0, os.getcwd())
+
+import pathlib
+import torch, torch.utils.data
+import cvae.tokenizer, cvae.distillation
+import cvae.models.multitask_transformer as mt
+import cvae.models.mixture_experts as me
+
+DEVICE = torch.device(f'cuda:0')
+
+# BUILD THE SHARED ENCODER MODEL FROM THE MOE CHECKPOINT ==============================
+teacher = me.MoE.load("brick/moe", execution='fused').to(DEVICE)
+student = me.SharedEncoderMoE.from_moe(teacher, encoder_expert=0).to(DEVICE)
+tokenizer = teacher.tokenizer
+
+teacher_params = sum(p.numel() for p in teacher.parameters())
+student_params = sum(p.numel() for p in student.parameters())
+print(f"teacher {teacher_params/1e6} million params, shared encoder student {student_params/1e6} million params")
+
+# DISTILL ===========================================================================
+trnds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/trn", tokenizer, nprops=5)
+trndl = torch.utils.data.DataLoader(trnds, batch_size=128, shuffle=True, num_workers=8, pin_memory=True, collate_fn=trnds.collate)
+valds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/tst", tokenizer, nprops=5)
+valdl = torch.utils.data.DataLoader(valds, batch_size=128, shuffle=False, num_workers=8, pin_memory=True, collate_fn=valds.collate)
+
+pathlib.Path("metrics").mkdir(exist_ok=True)
+trainer = cvae.distillation.DistillationTrainer(student, teacher, DEVICE, temperature=2.0, alpha=0.5)\
+    .set_trn_dataloader(trndl)\
+    .set_validation_dataloader(valdl)\
+    .set_max_epochs(2)\
+    .set_metrics_file(pathlib.Path("metrics/shared_encoder_distillation_loss.tsv"), overwrite=True)\
+    .set_model_savepath("brick/moe_shared")
+
+trainer.start()
@@ -0,0 +1,67 @@
+# purpose: distill the brick/moe mixture of experts into a single MultitaskTransformer student for cheaper serving.
+# the student learns the moe's temperature softened value-token distributions (plus the labels) over SequenceShiftDataset,
+# then student and teacher are compared with the 5_1_eval_multi_properties evaluation on the holdout set.
+# dependencies: brick/moe, data/tensordataset/multitask_tensors
+# outputs:
+#     - brick/mtransformer_student - MultitaskTransformer checkpoint, a drop-in model directory for the flask Predictor
+#     - data/metrics/distillation_metrics.csv - per property AUC of the teacher and the student and their difference
+import sys, os
+sys.path.insert(0, os.getcwd())
+
+import pathlib, time
+import torch, torch.utils.data
+import cvae.tokenizer, cvae.utils as utils, cvae.evaluation, cvae.distillation
+import cvae.models.multitask_transformer as mt
+import cvae.models.mixture_experts as me
+
+DEVICE = torch.device(f'cuda:0')
+STUDENT_CONFIG = {"hdim": 256, "nhead": 4, "num_layers": 4, "dim_feedforward": 512}
+
+# DISTILL ===========================================================================
+teacher = me.MoE.load("brick/moe", execution='fused').to(DEVICE)
+tokenizer = teacher.tokenizer
+student = mt.MultitaskTransformer(tokenizer, **STUDENT_CONFIG).to(DEVICE)
+
+teacher_params = sum(p.numel() for p in teacher.parameters())
+student_params = sum(p.numel() for p in student.parameters())
+print(f"teacher {teacher_params/1e6} million params, student {student_params/1e6} million params")
+
+trnds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/trn", tokenizer, nprops=5)
+trndl = torch.utils.data.DataLoader(trnds, batch_size=256, shuffle=True, num_workers=8, pin_memory=True, collate_fn=trnds.collate)
+valds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/tst", tokenizer, nprops=5)
+valdl = torch.utils.data.DataLoader(valds, batch_size=256, shuffle=False, num_workers=8, pin_memory=True, collate_fn=valds.collate)
+
+pathlib.Path("metrics").mkdir(exist_ok=True)
+# the KL term only compares the teacher and student distributions over the value tokens
+value_indexes = tokenizer.value_index_tensor(DEVICE)
+trainer = cvae.distillation.DistillationTrainer(student, teacher, DEVICE, temperature=2.0, alpha=0.3, value_indexes=value_indexes)\
+    .set_trn_dataloader(trndl)\
+    .set_validation_dataloader(valdl)\
+    .set_max_epochs(10)\
+    .set_mask_percent(0.1)\
+    .set_metrics_file(pathlib.Path("metrics/student_distillation_loss.tsv"), overwrite=True)\
+    .set_model_savepath("brick/mtransformer_student")
+
+trainer.start()
+
+# STUDENT VS TEACHER EVALUATION ======================================================
+student = mt.MultitaskTransformer.load("brick/mtransformer_student").to(DEVICE)
+nprops, batch_size, epochs = 5, 5, 10
+hldds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/hld", tokenizer, nprops=nprops)
+hlddl = torch.utils.data.DataLoader(hldds, batch_size=batch_size, shuffle=False, collate_fn=hldds.collate)
+
+metrics = {}
+for name, model in [('teacher', teacher), ('student', student)]:
+    # reseed so both models see the same random property subsets
+    torch.manual_seed(137)
+    start = time.time()
+    predictions = cvae.evaluation.eval_dataset(model.eval(), tokenizer, hlddl, nprops, DEVICE, epochs=epochs)
+    print(f"{name} evaluated in {time.time() - start:.1f}s")
+    metrics[name] = cvae.evaluation.property_metrics(predictions, tokenizer)
+
+metrics_df = metrics['teacher'].merge(metrics['student'], on=['nprops', 'assay'], suffixes=('_teacher', '_student'))
+metrics_df['AUC_delta'] = metrics_df['AUC_student'] - metrics_df['AUC_teacher']
+utils.mk_empty_directory("data/metrics", overwrite=False)
+metrics_df.to_csv("data/metrics/distillation_metrics.csv", index=False)
+
+print(metrics_df.groupby('nprops').aggregate({'AUC_teacher': 'median', 'AUC_student': 'median', 'AUC_delta': 'median', 'assay': 'count'}))
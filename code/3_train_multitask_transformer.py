@@ -7,6 +7,7 @@ import torch, torch.utils.data, torch.optim as optim
 import cvae.tokenizer, cvae.utils as utils
 import cvae.models.multitask_transformer as mt 
 import cvae.models.mixture_experts as me
+from cvae.models.augmentation import BatchAugmentation
 import sklearn.metrics
 
 DEVICE = torch.device(f'cuda:0')
@@ -28,6 +29,8 @@ class Trainer():
         self.savepath = "brick/mtransform2"
         self.test_losses = [np.inf]
         self.best_test_loss = np.inf
+        self.aux_loss_weight = 1e-2
+        self.augmentation = None
     
     def set_model_savepath(self, savepath):
         self.savepath = savepath
@@ -41,6 +44,45 @@ class Trainer():
         self.mask_percent = mask_percent
         return self
     
+    def set_augmentation(self, augmentation):
+        """ BatchAugmentation that builds the teach forcing, outputs and masking on the device,
+        the training iterator then yields raw (selfies, assay values) batches """
+        self.augmentation = augmentation
+        return self
+    
+    def set_aux_loss_weight(self, aux_loss_weight):
+        self.aux_loss_weight = aux_loss_weight
+        return self
+    
+    def set_checkpointing(self, checkpointing):
+        """ None, 'expert' or 'layer' activation checkpointing, see ExpertMixture.set_checkpointing.
+        compare the logged peak memory with it on and off to pick the largest batch size that fits """
+        self.model.module.set_checkpointing(checkpointing)
+        return self
+    
+    def load_training_state(self, path):
+        """ resume the data order, generator states, augmentation draws, optimizer, scheduler and best loss saved with a
+        checkpoint by _save_training_state, the training iterator must be a mt.ResumableLoader. Missing state is ignored
+        so fresh runs can call it too """
+        path = pathlib.Path(path) / "training_state.pt"
+        if path.exists():
+            # the generator states hold numpy arrays and python tuples, not only tensors
+            state = torch.load(path, weights_only=False)
+            self.trn_iterator.load_state_dict(state['loader'])
+            if self.augmentation is not None and state['augmentation'] is not None:
+                self.augmentation.set_state(state['augmentation'])
+            self.optimizer.load_state_dict(state['optimizer'])
+            self.scheduler.load_state_dict(state['scheduler'])
+            self.test_losses, self.best_test_loss = state['test_losses'], state['best_test_loss']
+        return self
+    
+    def _save_training_state(self):
+        augmentation = self.augmentation.get_state() if self.augmentation is not None else None
+        state = {'loader': self.trn_iterator.state_dict(), 'augmentation': augmentation,
+                 'optimizer': self.optimizer.state_dict(), 'scheduler': self.scheduler.state_dict(),
+                 'test_losses': self.test_losses, 'best_test_loss': self.best_test_loss}
+        torch.save(state, pathlib.Path(self.savepath) / "training_state.pt")
+    
     def set_validation_dataloader(self, valdl):
         self.valdl = valdl
         return self
@@ -56,8 +98,6 @@ class Trainer():
         total_bac = 0.0
         total_batches = 0  # Keep track of the total count of values considered for accuracy
 
-        value_indexes = torch.LongTensor(list(tokenizer.value_indexes().values())).to(DEVICE)
-
         for _, (inp, teach, out) in tqdm.tqdm(enumerate(valdl), total=len(valdl)):
             inp, teach, out = inp.to(DEVICE), teach.to(DEVICE), out.to(DEVICE)
             with torch.no_grad():
@@ -68,7 +108,7 @@ class Trainer():
                 prob = torch.softmax(pred, dim=2)
 
                 # Filter out the relevant outputs and predictions for balanced accuracy calculation
-                mask = torch.isin(out, value_indexes)
+                mask = tokenizer.is_value(out)
                 outval = torch.masked_select(out, mask)
                 prbval = torch.masked_select(torch.argmax(prob, dim=2), mask)
 
@@ -94,9 +134,10 @@ class Trainer():
         _ = self.model.train()
         self.optimizer.zero_grad()
         
-        # outputs and loss
-        pred = self.model(inp, teach)
+        # outputs and loss, the load balancing loss keeps sparse routing from collapsing onto a few experts
+        pred, aux_loss = self.model(inp, teach, return_aux_loss=True)
         loss = self.lossfn(self.model.parameters(), pred.permute(0,2,1), out)
+        loss = loss + self.aux_loss_weight * aux_loss.mean()
         
         # update model
         loss.backward()
@@ -104,8 +145,8 @@ class Trainer():
         return loss.item()
     
     def start(self):
-        i, (inp, teach, out) = next(self.trn_iterator)
-        batch_size = inp.size(0)
+        i, batch = next(self.trn_iterator)
+        batch_size = batch[0].size(0)
         
         # evaluate twice per epoch
         evaluation_interval = ((len(trnds)-1) // batch_size) // 4
@@ -116,16 +157,19 @@ class Trainer():
         
         while self._epochs_since_improvement() < 4000:
             
-            i, (inp, teach, out) = next(self.trn_iterator)
-            inp, teach, out = inp.to(DEVICE), teach.to(DEVICE), out.to(DEVICE)
-            
-            mask = torch.rand(inp.shape, device=DEVICE) < self.mask_percent
-            mask[:,0] = False # don't mask the first token
-            inp = inp.masked_fill(mask, tokenizer.pad_idx)
-            
-            mask = torch.rand(teach.shape, device=DEVICE) < self.mask_percent
-            mask[:,0] = False # don't mask the first token
-            teach = teach.masked_fill(mask, tokenizer.pad_idx,)
+            i, batch = next(self.trn_iterator)
+            if self.augmentation is not None:
+                inp, teach, out = self.augmentation(*batch)
+            else:
+                inp, teach, out = (tokens.to(DEVICE) for tokens in batch)
+                
+                mask = torch.rand(inp.shape, device=DEVICE) < self.mask_percent
+                mask[:,0] = False # don't mask the first token
+                inp = inp.masked_fill(mask, tokenizer.pad_idx)
+                
+                mask = torch.rand(teach.shape, device=DEVICE) < self.mask_percent
+                mask[:,0] = False # don't mask the first token
+                teach = teach.masked_fill(mask, tokenizer.pad_idx,)
 
             loss = self._train_batch(inp, teach, out)
             trn_loss.append(loss)
@@ -138,6 +182,11 @@ class Trainer():
                 # self.scheduler.step(mean_loss)
                 utils.write_path(self.metrics_path,f"scheduler\t{i}\t{mean_loss}\t{self.optimizer.param_groups[0]['lr']:.12f}\n")
                 trn_loss = []
+                
+                # peak memory per training batch since the last report
+                peak_gb = torch.cuda.max_memory_allocated(DEVICE) / 1e9
+                utils.write_path(self.metrics_path,f"memory\t{i}\t{peak_gb:.3f}\t{self.model.module.checkpointing}\n")
+                torch.cuda.reset_peak_memory_stats(DEVICE)
             
             # EVALUATION UPDATE
             if (i + 1) % evaluation_interval == 0:
@@ -148,6 +197,7 @@ class Trainer():
                 if eval_loss < self.best_test_loss:
                     self.best_test_loss = eval_loss
                     self.model.module.save(self.savepath)
+                    self._save_training_state()
                 
                 utils.write_path(self.metrics_path,f"eval\t{i}\t{self.test_losses[-1]}\n")
                 print(f"epoch: {epoch}\teval_loss: {self.best_test_loss:.4f}\teval_bac: {eval_bac:.4f}\tLR: {self.optimizer.param_groups[0]['lr']:.12f}")
@@ -157,6 +207,7 @@ importlib.reload(mt)
 importlib.reload(me)
 
 model = me.MoE(tokenizer).to(DEVICE)
+# model = me.MoE(tokenizer, num_experts=16, top_k=2, routing='token', capacity_factor=1.25).to(DEVICE)
 # model = me.MoE.load("brick/moe").to(DEVICE)
 model = torch.nn.DataParallel(model)
 trainable_params = sum(p.numel() for p in model.module.parameters() if p.requires_grad)
@@ -165,20 +216,28 @@ print(f"{trainable_params/1e9} billion parameters")
 # model = mt.MultitaskTransformer.load("brick/mtransform2").to(DEVICE)
 # model = torch.nn.DataParallel(model)
 
-trnds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/trn", tokenizer, nprops=5)
-trndl = torch.utils.data.DataLoader(trnds, batch_size=32*8, shuffle=True, prefetch_factor=20000, num_workers=80)
-valds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/tst", tokenizer, nprops=5)
-valdl = torch.utils.data.DataLoader(valds, batch_size=32*8, shuffle=True, prefetch_factor=20000, num_workers=80)
+# training batches are raw rows, the property shuffling and masking run on the gpu in BatchAugmentation
+trnds = mt.TokenStoreDataset("data/tensordataset/multitask_tokens/trn", tokenizer, nprops=5).set_raw(True)
+# length bucketed batches, collate trims each to its longest selfies on the host
+trndl = torch.utils.data.DataLoader(trnds, batch_sampler=mt.BucketBatchSampler(*trnds.sample_lengths(), 32*8, nprops=5, seed=137), prefetch_factor=100, num_workers=4, pin_memory=True, collate_fn=trnds.collate)
+valds = mt.TokenStoreDataset("data/tensordataset/multitask_tokens/tst", tokenizer, nprops=5)
+valdl = torch.utils.data.DataLoader(valds, batch_size=32*8, shuffle=True, prefetch_factor=100, num_workers=16, collate_fn=valds.collate)
 
 input, teach_forcing, out = next(iter(valdl))
 input, teach_forcing, out = input.to(DEVICE), teach_forcing.to(DEVICE), out.to(DEVICE)
 model(input, teach_forcing).shape
 
 trainer = Trainer(model)\
-    .set_trn_iterator(itertools.cycle(enumerate(trndl)))\
+    .set_trn_iterator(mt.ResumableLoader(trndl))\
     .set_validation_dataloader(valdl)\
     .set_mask_percent(0.1)\
+    .set_augmentation(BatchAugmentation(tokenizer, nprops=5, mask_percent=0.1, device=DEVICE).manual_seed(137))\
+    .set_aux_loss_weight(1e-2)\
+    .set_checkpointing(None)\
     .set_metrics_file(pathlib.Path("metrics/multitask_loss.tsv"), overwrite=True)\
     .set_model_savepath("brick/moe")
 
+# to resume a run load the model with me.MoE.load("brick/moe") above, then continue from the next unconsumed batch with
+# trainer.load_training_state("brick/moe")
+
 trainer.start()
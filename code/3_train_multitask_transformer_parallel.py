@@ -27,7 +27,8 @@ def cleanup():
 class Trainer():
     def __init__(self, model, rank, tokenizer, max_epochs=10):
         self.rank = rank
-        self.model = DDP(model.to(rank), device_ids=[rank])
+        # experts that receive no sequences under sparse routing have no gradient for that step
+        self.model = DDP(model.to(rank), device_ids=[rank], find_unused_parameters=model.is_sparse())
         self.optimizer = optim.AdamW(model.parameters(), lr=1e-5, betas=(0.9, 0.98), eps=1e-9)
         self.lossfn = mt.MultitaskTransformer.lossfn(ignore_index=tokenizer.pad_idx)
         self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, mode='min', factor=0.5, patience=5, min_lr=1e-7)
@@ -35,6 +36,7 @@ class Trainer():
         self.metrics_path = None
         self.best_loss = np.inf
         self.tokenizer=tokenizer
+        self.aux_loss_weight = 1e-2
     
     def set_model_savepath(self, savepath):
         self.savepath = pathlib.Path(savepath)
@@ -45,6 +47,30 @@ class Trainer():
         self.trn_iterator = iterator
         return self
 
+    def load_training_state(self, path):
+        """ resume the data order, generator states, optimizer, scheduler and best loss saved with a checkpoint by
+        _save_training_state, the training iterator must be a mt.ResumableLoader. every rank restores its own loader
+        state, missing state is ignored so fresh runs can call it too """
+        path = pathlib.Path(path) / "training_state.pt"
+        if path.exists():
+            # the generator states hold numpy arrays and python tuples, not only tensors
+            state = torch.load(path, map_location='cpu', weights_only=False)
+            self.trn_iterator.load_state_dict(state['loaders'][self.rank])
+            self.optimizer.load_state_dict(state['optimizer'])
+            self.scheduler.load_state_dict(state['scheduler'])
+            self.best_loss = state['best_loss']
+        return self
+
+    def _save_training_state(self):
+        """ called by every rank, each rank's loader state holds its own generator states and is gathered to rank 0.
+        the optimizer and scheduler are the same on every rank under DDP, rank 0 saves its copy """
+        loaders = [None] * dist.get_world_size()
+        dist.all_gather_object(loaders, self.trn_iterator.state_dict())
+        if self.rank == 0:
+            state = {'loaders': loaders, 'optimizer': self.optimizer.state_dict(), 'scheduler': self.scheduler.state_dict(),
+                     'best_loss': self.best_loss}
+            torch.save(state, self.savepath / "training_state.pt")
+
     def set_validation_dataloader(self, valdl):
         self.valdl = valdl
         return self
@@ -53,6 +79,16 @@ class Trainer():
         self.mask_percent = mask_percent
         return self
 
+    def set_aux_loss_weight(self, aux_loss_weight):
+        self.aux_loss_weight = aux_loss_weight
+        return self
+
+    def set_checkpointing(self, checkpointing):
+        """ None, 'expert' or 'layer' activation checkpointing, see ExpertMixture.set_checkpointing.
+        compare the logged peak memory with it on and off to pick the largest batch size that fits """
+        self.model.module.set_checkpointing(checkpointing)
+        return self
+
     def set_metrics_file(self, metrics_path, overwrite=False):
         if self.rank == 0:
             self.metrics_path = metrics_path
@@ -91,60 +127,74 @@ class Trainer():
     def _train_batch(self, inp, teach, out):
         self.optimizer.zero_grad()
         inp, teach, out = inp.to(self.rank), teach.to(self.rank), out.to(self.rank)
-        pred = self.model(inp, teach)
+        pred, aux_loss = self.model(inp, teach, return_aux_loss=True)
         loss = self.lossfn(self.model.module.parameters(), pred.permute(0, 2, 1), out)
+        loss = loss + self.aux_loss_weight * aux_loss
         loss.backward()
         self.optimizer.step()
         return loss.item()
 
     def start(self):
-        total_batches = len(self.trn_iterator)
+        total_batches = len(self.trn_iterator.dataloader)
         self.validation_interval = total_batches // 4  # Evaluate four times per epoch
-        for epoch in range(self.max_epochs):
-            self.valdl.sampler.set_epoch(epoch)
-            self.trn_iterator.sampler.set_epoch(epoch)  # Ensure randomness in distributed training
-            for i, (inp, teach, out) in enumerate(self.trn_iterator):
-                loss = self._train_batch(inp, teach, out)
-                if self.rank == 0:
-                    with open(self.metrics_path, 'a') as f:
-                        f.write(f"{epoch}\t{i}\ttrain\t{loss:.4f}\n")
+        # the ResumableLoader sets the sampler epoch and start, a resumed run continues mid epoch
+        for step, (inp, teach, out) in self.trn_iterator:
+            epoch, i = self.trn_iterator.epoch, self.trn_iterator.batch - 1
+            if epoch >= self.max_epochs:
+                break
+            loss = self._train_batch(inp, teach, out)
+            if self.rank == 0:
+                with open(self.metrics_path, 'a') as f:
+                    f.write(f"{epoch}\t{i}\ttrain\t{loss:.4f}\n")
+            
+            if step % 100 == 0:
+                eval_loss = self._evaluation_loss()
+                self.scheduler.step(eval_loss)
                 
-                if i % 100 == 0:
-                    eval_loss = self._evaluation_loss()
-                    self.scheduler.step(eval_loss)
-                    
+                # eval_loss is reduced over all ranks, so every rank takes this branch and joins the state gather
+                if eval_loss < self.best_loss:
+                    self.best_loss = eval_loss
                     if self.rank == 0:
-                        if eval_loss < self.best_loss:
-                            self.model.module.save(self.savepath)
-                            
-                        with open(self.metrics_path, 'a') as f:
-                            lr = self.optimizer.param_groups[0]['lr']
-                            f.write(f"{epoch}\t{i}\teval\t{eval_loss:.4f}\t{lr}\n")
-                            print(f"Epoch: {epoch}, Step: {i}, Train Loss: {loss:.4f}, Eval Loss: {eval_loss:.4f}, LR: {lr}")
+                        self.model.module.save(self.savepath)
+                    self._save_training_state()
+                
+                if self.rank == 0:
+                    # peak memory per batch since the last evaluation, including the evaluation itself
+                    peak_gb = torch.cuda.max_memory_allocated(self.rank) / 1e9
+                    with open(self.metrics_path, 'a') as f:
+                        lr = self.optimizer.param_groups[0]['lr']
+                        f.write(f"{epoch}\t{i}\teval\t{eval_loss:.4f}\t{lr}\n")
+                        f.write(f"{epoch}\t{i}\tmemory\t{peak_gb:.3f}\t{self.model.module.checkpointing}\n")
+                        print(f"Epoch: {epoch}, Step: {i}, Train Loss: {loss:.4f}, Eval Loss: {eval_loss:.4f}, LR: {lr}, Peak memory: {peak_gb:.2f}GB")
+                torch.cuda.reset_peak_memory_stats(self.rank)
 
 
 def main(rank, world_size):
     setup(rank, world_size)
     tokenizer = cvae.tokenizer.SelfiesPropertyValTokenizer.load('brick/selfies_property_val_tokenizer')
     model = me.MoE(tokenizer)
+    # model = me.MoE(tokenizer, num_experts=16, top_k=2, routing='token', capacity_factor=1.25)
     # model = me.MoE.load("brick/moe")
     num_params = sum(p.numel() for p in model.parameters() if p.requires_grad)
     
     
-    trnds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/trn", tokenizer, nprops=5)
+    trnds = mt.TokenStoreDataset("data/tensordataset/multitask_tokens/trn", tokenizer, nprops=5)
     trndl = torch.utils.data.DataLoader(
-        trnds, batch_size=16*8, shuffle=False, num_workers=4, pin_memory=True,
-        sampler=torch.utils.data.distributed.DistributedSampler(trnds, num_replicas=world_size, rank=rank)
+        trnds, num_workers=4, pin_memory=True,
+        batch_sampler=mt.BucketBatchSampler(*trnds.sample_lengths(), batch_size=16*8, nprops=5, seed=137, rank=rank, world_size=world_size),
+        collate_fn=trnds.collate_trimmed
     )
     
-    valds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/tst", tokenizer, nprops=5)
-    valdl = torch.utils.data.DataLoader(valds, batch_size=16*8, shuffle=False, num_workers=0, pin_memory=True,
-        sampler=torch.utils.data.distributed.DistributedSampler(valds, num_replicas=world_size, rank=rank))
+    valds = mt.TokenStoreDataset("data/tensordataset/multitask_tokens/tst", tokenizer, nprops=5)
+    # a fixed gpu resident subset, the same batches are evaluated every 100 steps without resampling or workers
+    valdl = mt.ValidationBundle.build(valds, size=50_000, batch_size=16*8, seed=137, rank=rank, world_size=world_size, device=rank)
     
     trainer = Trainer(model, rank, tokenizer, max_epochs=10)\
-        .set_trn_iterator(trndl)\
+        .set_trn_iterator(mt.ResumableLoader(trndl))\
         .set_validation_dataloader(valdl)\
         .set_mask_percent(0.1)\
+        .set_aux_loss_weight(1e-2)\
+        .set_checkpointing(None)\
         .set_model_savepath('brick/moe')\
         .set_metrics_file(pathlib.Path("metrics/multitask_loss.tsv"), overwrite=True)
     
@@ -153,6 +203,9 @@ def main(rank, world_size):
         print(f"Process {rank} has {len(valdl)} batches to validate.")
         print(f"{num_params/1e6} million params")
         
+    # to resume a run load the model with me.MoE.load("brick/moe") above, then continue from the next unconsumed batch with
+    # trainer.load_training_state("brick/moe")
+
     trainer.start()
 
     cleanup()
@@ -152,9 +152,9 @@ importlib.reload(mt)
 model = mt.MultitaskTransformer.load("brick/mtransform_addtokens2").to(DEVICE)
 
 trnds = mt.SequenceShiftDataset("data/processed/multitask_tensors/trn", tokenizer)
-trndl = torch.utils.data.DataLoader(trnds, batch_size=124, shuffle=True, prefetch_factor=100, num_workers=20)
+trndl = torch.utils.data.DataLoader(trnds, batch_size=124, shuffle=True, prefetch_factor=100, num_workers=20, collate_fn=trnds.collate)
 valds = mt.SequenceShiftDataset("data/processed/multitask_tensors/tst", tokenizer)
-valdl = torch.utils.data.DataLoader(valds, batch_size=124, shuffle=True, prefetch_factor=100, num_workers=20)
+valdl = torch.utils.data.DataLoader(valds, batch_size=124, shuffle=True, prefetch_factor=100, num_workers=20, collate_fn=valds.collate)
 # (i,o) = valds[0]
 
 # inp, teach, out = valds[0]
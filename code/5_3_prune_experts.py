@@ -0,0 +1,63 @@
+# purpose: measure how brick/moe's gating network uses its experts and prune the low utility experts into a smaller checkpoint.
+# gating statistics are collected during the holdout evaluation, experts whose mean gating weight is below
+# MIN_WEIGHT_FRACTION of a uniform share are dropped and the pruned model is evaluated against the full one.
+# dependencies: brick/moe, data/tensordataset/multitask_tensors/hld
+# outputs:
+#     - data/metrics/gating_expert_stats.csv - mean gating weight, argmax share and entropy of every expert
+#     - data/metrics/gating_property_stats.csv - the same statistics per assay token and expert
+#     - data/metrics/pruning_metrics.csv - per property AUC of the full and pruned models and their difference
+#     - brick/moe_pruned - pruned, sharded MoE checkpoint, loaded with cvae.models.mixture_experts.load_model
+import sys, os
+sys.path.insert(0, os.getcwd())
+
+import time, torch, torch.utils.data
+import cvae.utils as utils, cvae.evaluation
+import cvae.models.multitask_transformer as mt
+import cvae.models.mixture_experts as me
+from cvae.models.gating_telemetry import GatingTelemetry
+
+DEVICE = torch.device(f'cuda:0')
+MIN_WEIGHT_FRACTION = 0.5
+
+model = me.load_model("brick/moe").to(DEVICE).eval()
+tokenizer = model.tokenizer
+utils.mk_empty_directory("data/metrics", overwrite=False)
+
+nprops, batch_size, epochs = 5, 5, 10
+hldds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/hld", tokenizer, nprops=nprops)
+hlddl = torch.utils.data.DataLoader(hldds, batch_size=batch_size, shuffle=False, collate_fn=hldds.collate)
+
+# GATING TELEMETRY AND FULL MODEL EVALUATION =========================================
+torch.manual_seed(137)
+with GatingTelemetry(model) as telemetry:
+    full_predictions = cvae.evaluation.eval_dataset(model, tokenizer, hlddl, nprops, DEVICE, epochs=epochs)
+
+expert_stats = telemetry.expert_stats()
+expert_stats.to_csv("data/metrics/gating_expert_stats.csv", index=False)
+telemetry.property_stats().to_csv("data/metrics/gating_property_stats.csv", index=False)
+print(expert_stats)
+
+# PRUNE ===============================================================================
+# keep the experts with a meaningful share of the gating weight, and at least as many as the router sends each token to
+min_weight = MIN_WEIGHT_FRACTION / model.num_experts
+ranked = expert_stats.sort_values('mean_weight', ascending=False)
+keep = ranked[ranked['mean_weight'] >= min_weight]['expert'].tolist()
+keep = keep if len(keep) >= (model.top_k or 1) else ranked['expert'].tolist()[:(model.top_k or 1)]
+print(f"keeping experts {sorted(keep)} of {model.num_experts}")
+
+pruned = model.prune(keep).eval()
+pruned.save("brick/moe_pruned", sharded=True)
+
+# PRUNED VS FULL EVALUATION ===========================================================
+torch.manual_seed(137)
+start = time.time()
+pruned_predictions = cvae.evaluation.eval_dataset(pruned, tokenizer, hlddl, nprops, DEVICE, epochs=epochs)
+print(f"pruned model evaluated in {time.time() - start:.1f}s")
+
+full_metrics = cvae.evaluation.property_metrics(full_predictions, tokenizer)
+pruned_metrics = cvae.evaluation.property_metrics(pruned_predictions, tokenizer)
+metrics_df = full_metrics.merge(pruned_metrics, on=['nprops', 'assay'], suffixes=('_full', '_pruned'))
+metrics_df['AUC_delta'] = metrics_df['AUC_pruned'] - metrics_df['AUC_full']
+metrics_df.to_csv("data/metrics/pruning_metrics.csv", index=False)
+
+print(metrics_df.groupby('nprops').aggregate({'AUC_full': 'median', 'AUC_pruned': 'median', 'AUC_delta': 'median', 'assay': 'count'}))
@@ -0,0 +1,65 @@
+# purpose: calibrate the MoE skip_threshold, the gating weight below which an expert is not evaluated for a sequence.
+# every threshold is evaluated on the same holdout property subsets, recording per property AUC against the full model,
+# the number of expert evaluations per sequence and the evaluation time.
+# dependencies: brick/moe, data/tensordataset/multitask_tensors/hld
+# outputs:
+#     - data/metrics/expert_skipping_calibration.csv - per threshold, position and property AUC and its difference to no skipping
+#     - data/metrics/expert_skipping_summary.csv - per threshold median AUC delta, experts per sequence and seconds
+# serve with a calibrated threshold through cvae.models.mixture_experts.load_model("brick/moe", skip_threshold=...)
+import sys, os
+sys.path.insert(0, os.getcwd())
+
+import time, pandas as pd, torch, torch.utils.data
+import cvae.utils as utils, cvae.evaluation
+import cvae.models.multitask_transformer as mt
+import cvae.models.mixture_experts as me
+
+DEVICE = torch.device(f'cuda:0')
+THRESHOLDS = [None, 0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5]
+
+model = me.load_model("brick/moe").to(DEVICE).eval()
+tokenizer = model.tokenizer
+utils.mk_empty_directory("data/metrics", overwrite=False)
+
+nprops, batch_size, epochs = 5, 5, 10
+hldds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/hld", tokenizer, nprops=nprops)
+hlddl = torch.utils.data.DataLoader(hldds, batch_size=batch_size, shuffle=False, collate_fn=hldds.collate)
+
+# count the rows every expert is evaluated on and the sequences the model is called with
+counts = {'expert_rows': 0, 'sequences': 0}
+def count_expert_rows(module, args, output): counts['expert_rows'] += args[0].size(0)
+def count_sequences(module, args): counts['sequences'] += args[0].size(0)
+handles = [expert.register_forward_hook(count_expert_rows) for expert in model.experts]
+handles.append(model.register_forward_pre_hook(count_sequences))
+
+metrics, summary = [], []
+for threshold in THRESHOLDS:
+    model.skip_threshold = threshold
+    counts['expert_rows'], counts['sequences'] = 0, 0
+    torch.manual_seed(137)
+    torch.cuda.synchronize(DEVICE)
+    start = time.time()
+    predictions = cvae.evaluation.eval_dataset(model, tokenizer, hlddl, nprops, DEVICE, epochs=epochs)
+    torch.cuda.synchronize(DEVICE)
+    seconds = time.time() - start
+
+    threshold_metrics = cvae.evaluation.property_metrics(predictions, tokenizer).assign(threshold=threshold)
+    metrics.append(threshold_metrics)
+    summary.append({'threshold': threshold, 'seconds': seconds, 'experts_per_sequence': counts['expert_rows'] / max(counts['sequences'], 1)})
+    print(f"threshold {threshold}: {summary[-1]['experts_per_sequence']:.2f} experts per sequence, {seconds:.1f}s")
+
+for handle in handles:
+    handle.remove()
+
+# PER PROPERTY AND SUMMARY REPORTS =====================================================
+metrics_df = pd.concat(metrics)
+full_df = metrics_df[metrics_df['threshold'].isna()][['nprops', 'assay', 'AUC']].rename(columns={'AUC': 'AUC_full'})
+metrics_df = metrics_df.merge(full_df, on=['nprops', 'assay'])
+metrics_df['AUC_delta'] = metrics_df['AUC'] - metrics_df['AUC_full']
+metrics_df.to_csv("data/metrics/expert_skipping_calibration.csv", index=False)
+
+summary_df = pd.DataFrame(summary)
+auc_delta = metrics_df.groupby('threshold', dropna=False).aggregate({'AUC_delta': 'median', 'AUC': 'median'}).reset_index()
+summary_df = summary_df.merge(auc_delta, on='threshold', how='left')
+summary_df.to_csv("data/metrics/expert_skipping_summary.csv", index=False)
+print(summary_df)
@@ -0,0 +1,43 @@
+# purpose: compare cpu inference latency of the eager, torch.compile and traced brick/moe per shape bucket.
+# dependencies: brick/moe, brick/moe_traced (code/8_export_traced_model.py)
+# outputs:
+#     - data/metrics/inference_latency.csv - median and p90 milliseconds per call for each mode and bucket
+import sys, os
+sys.path.insert(0, os.getcwd())
+
+import time, numpy as np, pandas as pd, torch
+import cvae.utils as utils
+import cvae.models.mixture_experts as me
+import cvae.models.export as export
+
+DEVICE = torch.device('cpu')
+WARMUP, REPEATS = 5, 50
+
+eager = me.load_model("brick/moe").to(DEVICE).eval()
+tokenizer = eager.tokenizer
+compiled = torch.compile(eager, dynamic=False)
+traced = export.TracedModel.load("brick/moe_traced")
+
+def latency(model, input, teach_forcing):
+    "milliseconds per call after warmup, the first compiled calls include compilation"
+    times = []
+    with torch.no_grad():
+        for i in range(WARMUP + REPEATS):
+            start = time.perf_counter()
+            model(input, teach_forcing)
+            if i >= WARMUP: times.append((time.perf_counter() - start) * 1000)
+    return np.median(times), np.percentile(times, 90)
+
+rows = []
+for batch_size, selfies_length, teach_length in export.DEFAULT_BUCKETS:
+    input, teach_forcing = export.example_inputs(tokenizer, batch_size, selfies_length, teach_length)
+    for mode, model in [('eager', eager), ('compile', compiled), ('traced', traced)]:
+        median, p90 = latency(model, input, teach_forcing)
+        rows.append({'mode': mode, 'batch_size': batch_size, 'selfies_length': selfies_length,
+                     'teach_length': teach_length, 'median_ms': median, 'p90_ms': p90})
+        print(f"{mode}\t{batch_size}x{selfies_length}x{teach_length}\tmedian {median:.2f}ms\tp90 {p90:.2f}ms")
+
+latency_df = pd.DataFrame(rows)
+utils.mk_empty_directory("data/metrics", overwrite=False)
+latency_df.to_csv("data/metrics/inference_latency.csv", index=False)
+print(latency_df.pivot_table(index=['batch_size', 'selfies_length', 'teach_length'], columns='mode', values='median_ms'))
@@ -0,0 +1,42 @@
+# purpose: export brick/moe to ONNX with a dynamic batch axis for serving in ONNX Runtime on cpu.
+# the graphs are exported to brick/moe_onnx.tmp and checked against the pytorch model on holdout batches,
+# brick/moe_onnx is only replaced once they match.
+# dependencies: brick/moe, data/tensordataset/multitask_tensors/hld
+# outputs:
+#     - brick/moe_onnx - one ONNX graph per teach forcing length, manifest.json and tokenizer, set CVAE_MODEL_PATH=brick/moe_onnx for the flask Predictor
+import sys, os, shutil, pathlib
+sys.path.insert(0, os.getcwd())
+
+import numpy as np, torch, torch.utils.data
+import cvae.models.multitask_transformer as mt
+import cvae.models.mixture_experts as me
+import cvae.models.export as export
+from cvae.models.onnx_model import OnnxModel
+
+model = me.load_model("brick/moe").to('cpu').eval()
+tokenizer = model.tokenizer
+outpath = pathlib.Path("brick/moe_onnx")
+path = export.export_onnx(model, "brick/moe_onnx.tmp", selfies_length=120, teach_lengths=export.ONNX_TEACH_LENGTHS)
+onnx_model = OnnxModel.load(path)
+
+# PARITY CHECK =======================================================================
+# nprops=5 gives the 12 token teach forcing, the single property query is the first 3 tokens of it
+hldds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/hld", tokenizer, nprops=5)
+hlddl = torch.utils.data.DataLoader(hldds, batch_size=16, shuffle=False, collate_fn=hldds.collate)
+
+max_diff = {teach_length: 0.0 for teach_length in export.ONNX_TEACH_LENGTHS}
+for i, (inp, teach, _) in enumerate(hlddl):
+    if i == 10: break
+    for teach_length in export.ONNX_TEACH_LENGTHS:
+        with torch.no_grad():
+            torch_logits = model(inp, teach[:, :teach_length]).numpy()
+        onnx_logits = onnx_model(inp.numpy(), teach[:, :teach_length].numpy())
+        max_diff[teach_length] = max(max_diff[teach_length], float(np.abs(torch_logits - onnx_logits).max()))
+
+print(f"max abs logit difference vs pytorch by teach forcing length {max_diff}")
+assert max(max_diff.values()) < 1e-3, f"onnx model does not match the pytorch model, left the graphs in {path}"
+
+if outpath.exists():
+    shutil.rmtree(outpath)
+shutil.move(path, outpath)
+print(f"wrote {outpath}")
@@ -0,0 +1,43 @@
+# purpose: trace brick/moe into a TorchScript module with one graph per shape bucket for serving without python model code.
+# the graphs are traced to brick/moe_traced.tmp and checked against the eager model on padded holdout batches,
+# brick/moe_traced is only replaced once they match.
+# dependencies: brick/moe, data/tensordataset/multitask_tensors/hld
+# outputs:
+#     - brick/moe_traced - model.pt with the bucket graphs and the weights they share, manifest.json and tokenizer, set CVAE_MODEL_PATH=brick/moe_traced for the flask Predictor
+import sys, os, shutil, pathlib
+sys.path.insert(0, os.getcwd())
+
+import torch, torch.utils.data
+import cvae.models.multitask_transformer as mt
+import cvae.models.mixture_experts as me
+import cvae.models.export as export
+
+# traced graphs are device specific, the flask Predictor falls back to cpu when no gpu is present
+DEVICE = torch.device('cpu')
+
+model = me.load_model("brick/moe").to(DEVICE).eval()
+tokenizer = model.tokenizer
+outpath = pathlib.Path("brick/moe_traced")
+path = export.trace_model(model, "brick/moe_traced.tmp", buckets=export.DEFAULT_BUCKETS, device=DEVICE)
+traced = export.TracedModel.load(path)
+
+# PARITY CHECK =======================================================================
+hldds = mt.SequenceShiftDataset("data/tensordataset/multitask_tensors/hld", tokenizer, nprops=5)
+hlddl = torch.utils.data.DataLoader(hldds, batch_size=8, shuffle=False, collate_fn=hldds.collate)
+
+max_diff = 0.0
+for i, (inp, teach, _) in enumerate(hlddl):
+    if i == 10: break
+    # trim the selfies padding so the traced model has to pad back up to a bucket
+    inp = inp[:, :max(int((inp != tokenizer.PAD_IDX).sum(dim=1).max()), 1)]
+    with torch.no_grad():
+        eager = model(inp, teach)
+    max_diff = max(max_diff, (eager - traced(inp, teach)).abs().max().item())
+
+print(f"traced {len(export.DEFAULT_BUCKETS)} buckets, max abs logit difference vs eager {max_diff:.2e}")
+assert max_diff < 1e-3, f"traced model does not match the eager model, left the graphs in {path}"
+
+if outpath.exists():
+    shutil.rmtree(outpath)
+shutil.move(path, outpath)
+print(f"wrote {outpath}")
@@ -0,0 +1,102 @@
+import numpy as np, torch, torch.optim as optim, tqdm
+import cvae.utils as utils
+from cvae.models.multitask_transformer import MultitaskTransformer
+
+class DistillationTrainer():
+    """ Trains a student model on a frozen teacher's logits with MultitaskTransformer.distillation_lossfn.
+
+    Both models take (input, teach_forcing) batches from SequenceShiftDataset.collate. The student is evaluated on the
+    distillation loss every evaluation_interval steps and saved with its own `save` whenever that loss improves:
+
+        trainer = DistillationTrainer(student, teacher, DEVICE, alpha=0.5)\\
+            .set_trn_dataloader(trndl)\\
+            .set_validation_dataloader(valdl)\\
+            .set_metrics_file(pathlib.Path("metrics/distillation_loss.tsv"), overwrite=True)\\
+            .set_model_savepath("brick/student")
+        trainer.start()
+    """
+
+    def __init__(self, student, teacher, device, temperature=2.0, alpha=0.5, value_indexes=None):
+        self.student = student
+        self.teacher = teacher
+        self.device = device
+        self.optimizer = optim.AdamW(student.parameters(), lr=1e-4, betas=(0.9, 0.98), eps=1e-9)
+        self.lossfn = MultitaskTransformer.distillation_lossfn(ignore_index=student.tokenizer.pad_idx, temperature=temperature, alpha=alpha, value_indexes=value_indexes)
+        self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, mode='min', factor=0.5, patience=5, min_lr=1e-7)
+        self.max_epochs = 10
+        self.evaluation_interval = 1000
+        self.mask_percent = 0.0
+        self.best_loss = np.inf
+
+    def set_model_savepath(self, savepath):
+        self.savepath = savepath
+        return self
+
+    def set_trn_dataloader(self, trndl):
+        self.trndl = trndl
+        return self
+
+    def set_validation_dataloader(self, valdl):
+        self.valdl = valdl
+        return self
+
+    def set_max_epochs(self, max_epochs):
+        self.max_epochs = max_epochs
+        return self
+
+    def set_mask_percent(self, mask_percent):
+        "fraction of selfies tokens replaced by padding in training, the teacher sees the same masked input"
+        self.mask_percent = mask_percent
+        return self
+
+    def set_metrics_file(self, metrics_path, overwrite=False):
+        self.metrics_path = metrics_path
+        if overwrite: utils.write_path(self.metrics_path, "epoch\tstep\ttype\tloss\n", mode='w')
+        return self
+
+    def _distillation_loss(self, inp, teach, out):
+        with torch.no_grad():
+            teacher_logits = self.teacher(inp, teach)
+        return self.lossfn(self.student(inp, teach), teacher_logits, out)
+
+    def _evaluation_loss(self):
+        self.student.eval()
+        total_loss, num_samples = 0.0, 0
+        for inp, teach, out in tqdm.tqdm(self.valdl):
+            inp, teach, out = inp.to(self.device), teach.to(self.device), out.to(self.device)
+            with torch.no_grad():
+                total_loss += self._distillation_loss(inp, teach, out).item() * inp.size(0)
+                num_samples += inp.size(0)
+        return total_loss / num_samples
+
+    def _train_batch(self, inp, teach, out):
+        self.student.train()
+        self.optimizer.zero_grad()
+
+        if self.mask_percent > 0:
+            mask = torch.rand(inp.shape, device=self.device) < self.mask_percent
+            mask[:,0] = False # don't mask the first token
+            inp = inp.masked_fill(mask, self.student.tokenizer.pad_idx)
+
+        loss = self._distillation_loss(inp, teach, out)
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(self.student.parameters(), max_norm=1.0)
+        self.optimizer.step()
+        return loss.item()
+
+    def start(self):
+        for epoch in range(self.max_epochs):
+            for i, (inp, teach, out) in enumerate(self.trndl):
+                inp, teach, out = inp.to(self.device), teach.to(self.device), out.to(self.device)
+                loss = self._train_batch(inp, teach, out)
+                utils.write_path(self.metrics_path, f"{epoch}\t{i}\ttrain\t{loss:.4f}\n")
+
+                if (i + 1) % self.evaluation_interval == 0:
+                    eval_loss = self._evaluation_loss()
+                    self.scheduler.step(eval_loss)
+                    if eval_loss < self.best_loss:
+                        self.best_loss = eval_loss
+                        self.student.save(self.savepath)
+
+                    utils.write_path(self.metrics_path, f"{epoch}\t{i}\teval\t{eval_loss:.4f}\n")
+                    print(f"epoch: {epoch}\tstep: {i}\teval_loss: {eval_loss:.4f}\tLR: {self.optimizer.param_groups[0]['lr']:.12f}")
@@ -0,0 +1,106 @@
+import itertools
+import numpy as np, pandas as pd, sklearn.metrics, torch, tqdm
+
+def run_eval(model, tokenizer, i, raw_inp, raw_out, nprops, batch_size, device):
+    """ Predict every permutation of the first nprops property-values of each chemical in a batch.
+
+    Returns a dataframe with one row per predicted value, or None when no chemical in the batch has nprops properties.
+    Chemical ids are `i * batch_size` plus the position in the batch, so the dataloader must not shuffle.
+    """
+    value_indexes = tokenizer.value_index_tensor(device)
+    inp, raw_out = raw_inp.to(device), raw_out.to(device)
+
+    # filter to instances with at least nprops properties
+    x = torch.greater_equal(torch.sum(tokenizer.is_value(raw_out),dim=1),nprops)
+    chemical_id = torch.where(x)[0] + (i * batch_size)
+    inp, trunc_out = inp[x], raw_out[x,1:(2*nprops + 1)].reshape(-1,nprops,2)
+
+    # if all of x is false skip
+    if len(chemical_id) == 0:
+        return None
+
+    # get all permutations
+    perm_indices = list(itertools.permutations(range(nprops)))
+    perm_out = torch.cat([trunc_out[:, list(perm), :] for perm in perm_indices],dim=0).reshape(-1,nprops*2)
+    sep_tensor = torch.full((perm_out.size(0),1), tokenizer.SEP_IDX, device=raw_out.device)
+    zer_tensor = torch.zeros_like(sep_tensor, device=raw_out.device)
+    out = torch.cat([sep_tensor,perm_out,zer_tensor],dim=1)
+
+    # make teach tensor
+    one_tensor = torch.ones_like(sep_tensor, device=out.device)
+    teach = torch.cat([one_tensor, out[:,:-1]], dim=1)
+
+    # repeat interleave input for all the permutations. if inp has idxs 1,2 then the below gives us 1,1,2,2
+    rep_inp = inp.repeat(len(perm_indices),1)
+
+    # get model predictions as a prob
+    with torch.no_grad():
+        prob = torch.softmax(model(rep_inp, teach),dim=2).detach()
+
+    # get out assays and the assay with the highest prob
+    is_assay, is_value = tokenizer.is_assay(out), tokenizer.is_value(out)
+    assays = out[is_assay].cpu().numpy()
+    prob_assays = torch.argmax(prob, dim=2)[is_assay].cpu().numpy()
+
+    # get out values and the value with the highest prob and the prob of the `1`` value
+    values = out[is_value].cpu().numpy()
+
+    probmax_vals = torch.argmax(prob, dim=2)[is_value].cpu().numpy()
+    rawprobs = prob[is_value][:,value_indexes]
+    probs = (rawprobs / rawprobs.sum(dim=1, keepdim=True))[:,1].cpu().numpy()
+
+    # get position of each value in the out tensor
+    num_props = torch.sum(is_assay, dim=1)
+    position = torch.cat([torch.arange(size.item()) for size in num_props]).cpu().numpy()
+
+    # repeat chemical_id for every permutation and property
+    chemical_id = torch.repeat_interleave(chemical_id, len(perm_indices))
+    chemical_id = torch.repeat_interleave(chemical_id, num_props).cpu().numpy()
+
+    # cut assays up into groups of nprops then build strings with assay 0, assay 0 + assay 1, assay 0 + assay 1 + assay 2, etc.
+    assays_reshaped = assays.reshape(-1, nprops).astype(str)
+    values_reshaped = values.reshape(-1, nprops).astype(str)
+    prior_assays = [' + '.join(assays_reshaped[i, :j+1]) for i in range(len(assays_reshaped)) for j in range(nprops)]
+    prior_values = [values_reshaped[i, :j+1] for i in range(len(values_reshaped)) for j in range(nprops)]
+    return pd.DataFrame({'batch': i, 'chemical_id': chemical_id,
+                         'prior_assays': prior_assays, 'prior_values': prior_values,
+                         'assay': assays,
+                         'value': values, 'probs':probs, 'nprops':position,
+                         'prob_assays': prob_assays, 'prob_vals': probmax_vals})
+
+def eval_dataset(model, tokenizer, dataloader, nprops, device, epochs=1):
+    """ run_eval over `epochs` passes of an unshuffled dataloader. SequenceShiftDataset draws a new random
+    subset of properties for every pass, predictions are deduplicated on chemical_id and prior_assays. """
+    batch_dfs = []
+    for _ in range(epochs):
+        for i, (raw_inp, _, raw_out) in tqdm.tqdm(enumerate(dataloader), total=len(dataloader)):
+            batch_df = run_eval(model, tokenizer, i, raw_inp, raw_out, nprops, dataloader.batch_size, device)
+            if batch_df is not None:
+                batch_dfs.append(batch_df)
+
+    out_df = pd.concat(batch_dfs)
+    return out_df.drop_duplicates(subset=['chemical_id', 'prior_assays'])
+
+def property_metrics(out_df, tokenizer, min_class_count=10, min_chemicals=20):
+    "AUC, accuracy, balanced accuracy and cross entropy stratified by position (nprops) and assay"
+    # binary label of every value token, looked up once for the whole frame
+    out_df = out_df.assign(label=tokenizer.value_labels(torch.as_tensor(out_df['value'].values)).numpy())
+
+    assay_metrics = []
+    grouped = out_df.groupby(['nprops','assay'])
+    for (position,assay), group in tqdm.tqdm(grouped):
+        y_true, y_pred = group['label'].values, group['probs'].values
+        nchem = len(group['chemical_id'].unique())
+        if sum(y_true==0) < min_class_count or sum(y_true==1) < min_class_count or nchem < min_chemicals : continue
+        assay_metrics.append({
+            'nprops': position,
+            'assay': assay,
+            'AUC': sklearn.metrics.roc_auc_score(y_true, y_pred),
+            'ACC': sklearn.metrics.accuracy_score(y_true, y_pred > 0.5),
+            'BAC': sklearn.metrics.balanced_accuracy_score(y_true, y_pred > 0.5),
+            'cross_entropy_loss': sklearn.metrics.log_loss(y_true, y_pred),
+            "NUM_POS": sum(y_true==1),
+            "NUM_NEG": sum(y_true==0)})
+
+    metrics_df = pd.DataFrame(assay_metrics)
+    return metrics_df.sort_values(by=['AUC'], ascending=False)
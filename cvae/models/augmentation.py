@@ -0,0 +1,48 @@
+import torch
+import cvae.models.multitask_transformer as mt
+
+class BatchAugmentation():
+    """ Builds training batches on the device from the raw (selfies, padded assay values) batches of a
+    SequenceShiftDataset with set_raw(True), so DataLoader workers only gather and stack rows.
+
+    The assay value pairs are shuffled, truncated to nprops and framed with SEP/END as SequenceShiftDataset does, the
+    teach forcing is the output shifted right, and mask_percent of the selfies and teach forcing tokens after the first
+    are replaced with padding. All random draws come from a generator on the device:
+
+        augmentation = BatchAugmentation(tokenizer, nprops=5, mask_percent=0.1, device=DEVICE).manual_seed(137)
+        inp, teach, out = augmentation(selfies, assay_vals)
+    """
+
+    def __init__(self, tokenizer, nprops=5, mask_percent=0.0, device='cpu'):
+        self.nprops = nprops
+        self.mask_percent = mask_percent
+        self.device = torch.device(device)
+        self.pad_idx, self.sep_idx, self.end_idx = tokenizer.PAD_IDX, tokenizer.SEP_IDX, tokenizer.END_IDX
+        self.generator = torch.Generator(device=self.device)
+        self.generator.seed()
+
+    def manual_seed(self, seed):
+        self.generator.manual_seed(seed)
+        return self
+
+    def get_state(self):
+        "generator state, restore it with set_state to repeat the same draws"
+        return self.generator.get_state()
+
+    def set_state(self, state):
+        self.generator.set_state(state)
+        return self
+
+    def _mask(self, tokens):
+        "replaces mask_percent of the tokens with padding, the first token is never masked"
+        if self.mask_percent <= 0:
+            return tokens
+        mask = torch.rand(tokens.shape, device=self.device, generator=self.generator) < self.mask_percent
+        mask[:, 0] = False
+        return tokens.masked_fill(mask, self.pad_idx)
+
+    def __call__(self, selfies, assay_vals):
+        selfies = selfies.to(self.device, non_blocking=True)
+        assay_vals = assay_vals.to(self.device, non_blocking=True)
+        teach, out = mt.shift_assay_vals(assay_vals, self.nprops, self.pad_idx, self.sep_idx, self.end_idx, generator=self.generator)
+        return self._mask(selfies), self._mask(teach), out
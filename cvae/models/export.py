@@ -0,0 +1,168 @@
+import json, pathlib, inspect, torch
+import cvae.utils
+from cvae.tokenizer.selfies_property_val_tokenizer import SelfiesPropertyValTokenizer
+from cvae.models.mixture_experts import ExpertMixture
+
+# (batch size, selfies length, teach forcing length) shape buckets. The selfies length and batch are padded up to
+# the bucket, teach forcing lengths must match exactly because the custom decoder mask lets odd positions see the next one.
+DEFAULT_BUCKETS = [(1, 32, 3), (1, 64, 3), (1, 120, 3), (8, 64, 3), (8, 120, 3), (32, 120, 12)]
+
+def example_inputs(tokenizer, batch_size, selfies_length, teach_length):
+    "a half padded selfies batch and a teach forcing batch of the given shape to trace with"
+    input = torch.full((batch_size, selfies_length), tokenizer.PAD_IDX, dtype=torch.long)
+    input[:, :max(selfies_length // 2, 2)] = tokenizer.selfies_tokenizer.symbol_to_index[tokenizer.selfies_tokenizer.SOS_TOKEN]
+    teach_forcing = torch.full((batch_size, teach_length), tokenizer.assay_id_to_token_idx(0), dtype=torch.long)
+    teach_forcing[:, 0], teach_forcing[:, 1] = 1, tokenizer.SEP_IDX
+    return input, teach_forcing
+
+class _Buckets(torch.nn.Module):
+    """ Holds the model and the stacked expert weights of fused execution as buffers, trace_model traces one method of a
+    subclass per shape bucket. Tensors reached through module attributes are traced as attributes instead of constants,
+    so every bucket graph reads the same weights and the stacks share storage with the expert parameters. """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+        mixtures = [module for module in model.modules() if isinstance(module, ExpertMixture)]
+        for i, mixture in enumerate(mixtures):
+            for name, stacked in mixture._stacked_expert_parameters().items():
+                self.register_buffer(f"stacked_{i}_{name.replace('.', '_')}", stacked)
+
+    def run(self, input, teach_forcing):
+        return self.model(input, teach_forcing)
+
+def _bucket_method(shape):
+    return "bucket_{}_{}_{}".format(*shape)
+
+def trace_model(model, path, buckets=DEFAULT_BUCKETS, device=torch.device('cpu')):
+    """ Trace an eval mode model into a TorchScript module with one method per shape bucket and save it with the tokenizer.
+
+    Masks are built while tracing and recorded as constants, so the graphs contain no python mask construction.
+    Mixtures of experts are traced with fused execution, their sparse routing is pure tensor ops in that mode.
+    The weights are saved once in model.pt and shared by all bucket methods.
+    Graphs are specialized to `device`, trace on the device that will serve them.
+    """
+    path = cvae.utils.mk_empty_directory(path, overwrite=True)
+    model = model.to(device).eval()
+    execution = getattr(model, 'execution', None)
+    if isinstance(model, ExpertMixture):
+        model.execution = 'fused'
+
+    model.tokenizer.save(cvae.utils.mk_empty_directory(path / "spvt_tokenizer", overwrite=True))
+    manifest = {"format": "torchscript", "device": str(device), "file": "model.pt", "buckets": []}
+    with torch.no_grad():
+        methods = {_bucket_method(shape): _Buckets.run for shape in buckets}
+        module = type("TracedBuckets", (_Buckets,), methods)(model) # builds the expert stacks before tracing
+        inputs = {}
+        for batch_size, selfies_length, teach_length in buckets:
+            input, teach_forcing = example_inputs(model.tokenizer, batch_size, selfies_length, teach_length)
+            inputs[_bucket_method((batch_size, selfies_length, teach_length))] = (input.to(device), teach_forcing.to(device))
+            manifest["buckets"].append({"shape": [batch_size, selfies_length, teach_length], "method": _bucket_method((batch_size, selfies_length, teach_length))})
+        torch.jit.save(torch.jit.trace_module(module, inputs, check_trace=False), path / manifest["file"])
+
+    if isinstance(model, ExpertMixture):
+        model.execution = execution
+    with open(path / "manifest.json", "w") as file:
+        json.dump(manifest, file)
+    return path
+
+def export_format(dirpath):
+    "'torchscript' or 'onnx' for exported model directories, None for checkpoints"
+    manifest_path = pathlib.Path(dirpath) / "manifest.json"
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, "r") as file:
+        return json.load(file).get("format")
+
+def is_traced(dirpath):
+    return export_format(dirpath) == "torchscript"
+
+class TracedModel():
+    """ Callable like the eager models. Inputs are padded to the smallest bucket with the same teach forcing length,
+    batches larger than the bucket are run in chunks. """
+
+    def __init__(self, tokenizer, graphs, device):
+        self.tokenizer = tokenizer
+        self.graphs = graphs # (batch size, selfies length, teach length) -> ScriptModule or method of one
+        self.device = device
+
+    def _bucket(self, batch_size, selfies_length, teach_length):
+        "shortest selfies bucket that fits, then the batch bucket that needs the fewest padded rows and calls"
+        shapes = [shape for shape in self.graphs if shape[1] >= selfies_length and shape[2] == teach_length]
+        if not shapes:
+            raise ValueError(f"no traced bucket for selfies length {selfies_length} and teach forcing length {teach_length}")
+        chunks = lambda shape: -(-batch_size // shape[0])
+        return min(shapes, key=lambda shape: (shape[1], chunks(shape) * shape[0], chunks(shape)))
+
+    def __call__(self, input, teach_forcing):
+        batch_size, selfies_length, teach_length = self._bucket(input.size(0), input.size(1), teach_forcing.size(1))
+        graph = self.graphs[(batch_size, selfies_length, teach_length)]
+        input = torch.nn.functional.pad(input, (0, selfies_length - input.size(1)), value=self.tokenizer.PAD_IDX)
+
+        outputs = []
+        for start in range(0, input.size(0), batch_size):
+            chunk_input, chunk_teach = input[start:start + batch_size], teach_forcing[start:start + batch_size]
+            # fill the batch with copies of the first row, all padding rows would have nothing to attend to
+            fill = batch_size - chunk_input.size(0)
+            chunk_input = torch.cat([chunk_input, chunk_input[:1].expand(fill, -1)])
+            chunk_teach = torch.cat([chunk_teach, chunk_teach[:1].expand(fill, -1)])
+            outputs.append(graph(chunk_input, chunk_teach)[:batch_size - fill])
+        return torch.cat(outputs)
+
+    @staticmethod
+    def load(dirpath):
+        dirpath = pathlib.Path(dirpath)
+        with open(dirpath / "manifest.json", "r") as file:
+            manifest = json.load(file)
+
+        device = torch.device(manifest["device"])
+        tokenizer = SelfiesPropertyValTokenizer.load(dirpath / "spvt_tokenizer")
+        # one module with a method per bucket, exports from before the weights were shared hold a file per bucket
+        module = torch.jit.load(dirpath / manifest["file"], map_location=device) if "file" in manifest else None
+        graphs = {tuple(bucket["shape"]): getattr(module, bucket["method"]) if module is not None else torch.jit.load(dirpath / bucket["file"], map_location=device)
+                  for bucket in manifest["buckets"]}
+        return TracedModel(tokenizer, graphs, device)
+
+# ONNX ===============================================================================
+# teach forcing lengths to export, 3 is the flask Predictor's single property query and 12 the 5 property evaluation
+ONNX_TEACH_LENGTHS = [3, 12]
+
+def export_onnx(model, path, selfies_length=120, teach_lengths=ONNX_TEACH_LENGTHS, opset_version=17):
+    """ Export an eval mode model to one ONNX graph per teach forcing length with a dynamic batch axis.
+
+    The decoder mask depends only on the teach forcing length and is recorded as a constant, selfies are padded
+    to `selfies_length` by OnnxModel. Mixtures of experts are exported with fused execution.
+    """
+    path = cvae.utils.mk_empty_directory(path, overwrite=True)
+    model = model.to('cpu').eval()
+    execution = getattr(model, 'execution', None)
+    if isinstance(model, ExpertMixture):
+        model.execution = 'fused'
+
+    model.tokenizer.save(cvae.utils.mk_empty_directory(path / "spvt_tokenizer", overwrite=True))
+    manifest = {"format": "onnx", "selfies_length": selfies_length, "pad_idx": model.tokenizer.PAD_IDX, "graphs": []}
+    dynamic_axes = {'input': {0: 'batch'}, 'teach_forcing': {0: 'batch'}, 'logits': {0: 'batch'}}
+    # releases that default to the dynamo exporter take a dynamo flag, older ones only have the torchscript exporter
+    exporter = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    # exported under no_grad like trace_model, so fused execution reads the cached expert stack and the graph holds one
+    # stacked initializer per weight instead of re-stacking every expert. the mha fast path is turned off meanwhile,
+    # under no_grad it converts the encoder input to a nested tensor which onnx can't express
+    fastpath = torch.backends.mha.get_fastpath_enabled()
+    torch.backends.mha.set_fastpath_enabled(False)
+    try:
+        with torch.no_grad():
+            for teach_length in teach_lengths:
+                input, teach_forcing = example_inputs(model.tokenizer, 2, selfies_length, teach_length)
+                model(input, teach_forcing) # builds the expert stack before tracing
+                filename = f"teach_{teach_length}.onnx"
+                torch.onnx.export(model, (input, teach_forcing), path / filename, input_names=['input', 'teach_forcing'],
+                                  output_names=['logits'], dynamic_axes=dynamic_axes, opset_version=opset_version, **exporter)
+                manifest["graphs"].append({"teach_length": teach_length, "file": filename})
+    finally:
+        torch.backends.mha.set_fastpath_enabled(fastpath)
+
+    if isinstance(model, ExpertMixture):
+        model.execution = execution
+    with open(path / "manifest.json", "w") as file:
+        json.dump(manifest, file)
+    return path
@@ -0,0 +1,117 @@
+import torch, torch.nn.functional as F
+from cvae.models.multitask_transformer import generate_custom_subsequent_mask
+
+# Batched evaluation of identical MultitaskTransformer experts. Parameters are stacked along a leading
+# NUM_EXPERTS dimension and every linear layer becomes one batched matmul over all experts, so the
+# parameter names (and the mtransformer.pt state dict) are those of the individual experts.
+
+def stack_parameters(experts):
+    "returns a dict from MultitaskTransformer parameter name to a NUM_EXPERTS x ... stacked tensor"
+    expert_params = [dict(expert.named_parameters()) for expert in experts]
+    return {name: torch.stack([params[name] for params in expert_params]) for name in expert_params[0]}
+
+def share_stacked_storage(experts, stacked):
+    "point every expert parameter at its slice of the stacked tensors so no second copy of the weights is kept"
+    for i, expert in enumerate(experts):
+        for name, param in expert.named_parameters():
+            param.data = stacked[name][i]
+    return stacked
+
+def shares_stacked_storage(experts, stacked):
+    return all(param.data_ptr() == stacked[name][i].data_ptr()
+               for i, expert in enumerate(experts) for name, param in expert.named_parameters())
+
+def _linear(x, weight, bias):
+    "x is NUM_EXPERTS x B x S x IN, weight NUM_EXPERTS x OUT x IN and bias NUM_EXPERTS x OUT"
+    out = torch.baddbmm(bias.unsqueeze(1), x.flatten(1, 2), weight.transpose(1, 2))
+    return out.view(*x.shape[:-1], weight.size(1))
+
+def _layer_norm(x, weight, bias, eps):
+    return F.layer_norm(x, weight.shape[-1:], eps=eps) * weight[:, None, None, :] + bias[:, None, None, :]
+
+def _attention(query, key_value, params, prefix, nhead, attn_mask, dropout_p):
+    num_experts, batch_size, q_len, hdim = query.shape
+    weight, bias = params[f'{prefix}.in_proj_weight'], params[f'{prefix}.in_proj_bias']
+
+    if query is key_value:
+        q, k, v = _linear(query, weight, bias).chunk(3, dim=-1)
+    else:
+        q = _linear(query, weight[:, :hdim], bias[:, :hdim])
+        k, v = _linear(key_value, weight[:, hdim:], bias[:, hdim:]).chunk(2, dim=-1)
+
+    # NUM_EXPERTS*B x HEADS x SEQUENCE x HEAD_DIM
+    heads = lambda x: x.reshape(num_experts * batch_size, x.size(2), nhead, hdim // nhead).transpose(1, 2)
+    attended = F.scaled_dot_product_attention(heads(q), heads(k), heads(v), attn_mask=attn_mask, dropout_p=dropout_p)
+    attended = attended.transpose(1, 2).reshape(num_experts, batch_size, q_len, hdim)
+
+    return _linear(attended, params[f'{prefix}.out_proj.weight'], params[f'{prefix}.out_proj.bias'])
+
+def _feedforward(x, params, prefix, dropout_p, training):
+    hidden = F.dropout(F.relu(_linear(x, params[f'{prefix}.linear1.weight'], params[f'{prefix}.linear1.bias'])), dropout_p, training)
+    return _linear(hidden, params[f'{prefix}.linear2.weight'], params[f'{prefix}.linear2.bias'])
+
+def _padding_mask(pad_mask, num_experts, q_len, dtype):
+    "B x S boolean pad mask to an additive NUM_EXPERTS*B x 1 x Q x S attention mask"
+    mask = torch.zeros(pad_mask.shape, dtype=dtype, device=pad_mask.device).masked_fill(pad_mask, float("-inf"))
+    return mask[:, None, None, :].expand(-1, 1, q_len, -1).repeat(num_experts, 1, 1, 1)
+
+def _hyperparameters(template):
+    decode_layer = template.decoder.layers[0]
+    return template.nhead, template.training, decode_layer.dropout.p, decode_layer.norm1.eps
+
+def embed(template, params, tokens):
+    "NUM_EXPERTS x B x SEQUENCE x HIDDEN positional embeddings of the tokens for every expert"
+    _, training, dropout_p, _ = _hyperparameters(template)
+    x = params['embedding.weight'][:, tokens]
+    return F.dropout(x + template.positional_encoding.pe[:, :x.size(2)], dropout_p, training)
+
+def fused_encode(template, params, input):
+    "returns the NUM_EXPERTS x B x SEQUENCE x HIDDEN memory of every expert and the B x SEQUENCE padding mask"
+    num_experts = params['embedding.weight'].size(0)
+    nhead, training, dropout_p, eps = _hyperparameters(template)
+    attn_dropout_p = dropout_p if training else 0.0
+
+    memory_mask = input == template.token_pad_idx
+    x = embed(template, params, input)
+    src_mask = _padding_mask(memory_mask, num_experts, input.size(1), x.dtype)
+    for i in range(len(template.encoder.layers)):
+        prefix = f'encoder.layers.{i}'
+        attended = _attention(x, x, params, f'{prefix}.self_attn', nhead, src_mask, attn_dropout_p)
+        x = _layer_norm(x + F.dropout(attended, dropout_p, training), params[f'{prefix}.norm1.weight'], params[f'{prefix}.norm1.bias'], eps)
+        x = _layer_norm(x + F.dropout(_feedforward(x, params, prefix, dropout_p, training), dropout_p, training),
+                        params[f'{prefix}.norm2.weight'], params[f'{prefix}.norm2.bias'], eps)
+    return x, memory_mask
+
+def fused_decode(template, params, x, memory, memory_mask):
+    """ Decode embedded teach forcing `x` against `memory`, both NUM_EXPERTS x B x SEQUENCE x HIDDEN, into
+    NUM_EXPERTS x B x SEQUENCE x TOKENS logits. Only the decoder, decoder_norm and classification_layers parameters are used.
+    """
+    num_experts = x.size(0)
+    nhead, training, dropout_p, eps = _hyperparameters(template)
+    attn_dropout_p = dropout_p if training else 0.0
+
+    tgt_mask = generate_custom_subsequent_mask(x.size(2)).to(device=x.device, dtype=x.dtype)
+    cross_mask = _padding_mask(memory_mask, num_experts, x.size(2), x.dtype)
+    for i in range(len(template.decoder.layers)):
+        prefix = f'decoder.layers.{i}'
+        attended = _attention(x, x, params, f'{prefix}.self_attn', nhead, tgt_mask, attn_dropout_p)
+        x = _layer_norm(x + F.dropout(attended, dropout_p, training), params[f'{prefix}.norm1.weight'], params[f'{prefix}.norm1.bias'], eps)
+        attended = _attention(x, memory, params, f'{prefix}.multihead_attn', nhead, cross_mask, attn_dropout_p)
+        x = _layer_norm(x + F.dropout(attended, dropout_p, training), params[f'{prefix}.norm2.weight'], params[f'{prefix}.norm2.bias'], eps)
+        x = _layer_norm(x + F.dropout(_feedforward(x, params, prefix, dropout_p, training), dropout_p, training),
+                        params[f'{prefix}.norm3.weight'], params[f'{prefix}.norm3.bias'], eps)
+    x = _layer_norm(x, params['decoder_norm.weight'], params['decoder_norm.bias'], template.decoder_norm.eps)
+
+    # CLASSIFICATION HEAD
+    x = F.leaky_relu(_linear(x, params['classification_layers.0.weight'], params['classification_layers.0.bias']))
+    x = F.leaky_relu(_linear(x, params['classification_layers.2.weight'], params['classification_layers.2.bias']))
+    return _linear(x, params['classification_layers.4.weight'], params['classification_layers.4.bias'])
+
+def fused_forward(template, params, input, teach_forcing):
+    """ Evaluate every expert on the same batch, returns NUM_EXPERTS x B x SEQUENCE x TOKENS logits.
+
+    `template` is one of the experts and supplies the shared hyperparameters and positional encoding,
+    `params` comes from stack_parameters.
+    """
+    memory, memory_mask = fused_encode(template, params, input)
+    return fused_decode(template, params, embed(template, params, teach_forcing), memory, memory_mask)
@@ -0,0 +1,87 @@
+import numpy as np, pandas as pd, torch
+import torch.nn.functional as F
+
+class GatingTelemetry():
+    """ Accumulates how an ExpertMixture's gating network distributes weight over its experts while the model is evaluated.
+
+    Statistics are kept for every non padded teach forcing position and, per property, for the positions whose teach
+    forcing token is an assay token, where the model predicts that assay's value. Use as a context manager around evaluation:
+
+        with GatingTelemetry(model) as telemetry:
+            cvae.evaluation.eval_dataset(model, ...)
+        telemetry.expert_stats(), telemetry.property_stats()
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.tokenizer = model.tokenizer
+        self.handles = []
+        self.teach_forcing = None
+        self.reset()
+
+    def reset(self):
+        num_experts, vocab_size = self.model.num_experts, self.tokenizer.vocab_size
+        self.positions, self.entropy, self.weight, self.argmax = 0, 0.0, torch.zeros(num_experts, dtype=torch.float64), torch.zeros(num_experts, dtype=torch.float64)
+        self.property_positions = torch.zeros(vocab_size, dtype=torch.float64)
+        self.property_entropy = torch.zeros(vocab_size, dtype=torch.float64)
+        self.property_weight = torch.zeros(vocab_size, num_experts, dtype=torch.float64)
+        self.property_argmax = torch.zeros(vocab_size, num_experts, dtype=torch.float64)
+        return self
+
+    def __enter__(self):
+        self.handles = [self.model.register_forward_pre_hook(self._capture_teach_forcing),
+                        self.model.gating_network.register_forward_hook(self._accumulate)]
+        return self
+
+    def __exit__(self, *args):
+        for handle in self.handles:
+            handle.remove()
+        self.handles, self.teach_forcing = [], None
+
+    def _capture_teach_forcing(self, module, args):
+        self.teach_forcing = args[1]
+
+    def _accumulate(self, module, args, gating_scores):
+        if self.teach_forcing is None:
+            return
+        with torch.no_grad():
+            if self.model.is_pruned():
+                gating_scores = gating_scores[..., self.model.expert_ids]
+            distribution = F.softmax(gating_scores.float(), dim=-1).cpu().double()
+            teach_forcing = self.teach_forcing.cpu()
+
+            entropy = -(distribution * distribution.clamp(min=1e-12).log()).sum(dim=-1)
+            argmax = F.one_hot(distribution.argmax(dim=-1), distribution.size(-1)).double()
+
+            positions = teach_forcing != self.tokenizer.PAD_IDX
+            self.positions += int(positions.sum())
+            self.entropy += float(entropy[positions].sum())
+            self.weight += distribution[positions].sum(dim=0)
+            self.argmax += argmax[positions].sum(dim=0)
+
+            properties = self.tokenizer.is_assay(teach_forcing)
+            tokens = teach_forcing[properties]
+            self.property_positions.index_add_(0, tokens, torch.ones(len(tokens), dtype=torch.float64))
+            self.property_entropy.index_add_(0, tokens, entropy[properties])
+            self.property_weight.index_add_(0, tokens, distribution[properties])
+            self.property_argmax.index_add_(0, tokens, argmax[properties])
+
+    def expert_stats(self):
+        "mean gating weight and argmax share of every expert, with expert_id the index in the unpruned gating network"
+        positions = max(self.positions, 1)
+        return pd.DataFrame({'expert': np.arange(self.model.num_experts), 'expert_id': self.model.expert_ids,
+                             'mean_weight': (self.weight / positions).numpy(), 'argmax_share': (self.argmax / positions).numpy(),
+                             'mean_entropy': self.entropy / positions, 'positions': self.positions})
+
+    def property_stats(self):
+        "one row per observed assay token and expert with the mean gating weight, argmax share and the assay's mean gating entropy"
+        tokens = torch.nonzero(self.property_positions).squeeze(1)
+        positions = self.property_positions[tokens].unsqueeze(1)
+        num_experts = self.model.num_experts
+        return pd.DataFrame({
+            'assay': tokens.repeat_interleave(num_experts).numpy(),
+            'expert': np.tile(np.arange(num_experts), len(tokens)),
+            'mean_weight': (self.property_weight[tokens] / positions).flatten().numpy(),
+            'argmax_share': (self.property_argmax[tokens] / positions).flatten().numpy(),
+            'mean_entropy': (self.property_entropy[tokens] / positions.squeeze(1)).repeat_interleave(num_experts).numpy(),
+            'positions': positions.squeeze(1).repeat_interleave(num_experts).long().numpy()})
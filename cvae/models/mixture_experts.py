@@ -1,47 +1,402 @@
-import pathlib, torch, torch.nn as nn, torch.nn.functional as F
-from cvae.models.multitask_transformer import PositionalEncoding, generate_custom_subsequent_mask, MultitaskTransformer, SelfiesPropertyValTokenizer
+import json, math, pathlib, torch, torch.nn as nn, torch.nn.functional as F, torch.utils.checkpoint
+from cvae.models.multitask_transformer import PositionalEncoding, generate_custom_subsequent_mask, run_transformer_stack, MultitaskTransformer, SelfiesPropertyValTokenizer
+import cvae.models.fused_experts as fused
 import cvae.utils
 
-class MoE(nn.Module):
-    def __init__(self, tokenizer, num_experts=8, hdim=256):
+def route_top_k(gating_distribution, pad_mask, top_k, routing='token', capacity_factor=None):
+    """ Build B x SEQUENCE x NUM_EXPERTS routing weights that keep only the top_k experts.
+
+    routing='token' picks experts for every position, routing='sequence' picks them once per sequence
+    from the gating distribution averaged over the non-pad positions. Selected weights are renormalized to sum to 1.
+    With a capacity_factor each expert accepts at most ceil(capacity_factor * B * top_k / NUM_EXPERTS) sequences,
+    sequences beyond capacity (lowest routed weight first) are dropped for that expert. Capacity makes the outputs of a
+    sequence depend on the rest of its batch, ExpertMixture only applies it in training.
+    """
+    batch_size, num_experts = gating_distribution.size(0), gating_distribution.size(-1)
+
+    if routing == 'token':
+        topk_vals, topk_idx = gating_distribution.topk(top_k, dim=-1)
+        route = torch.zeros_like(gating_distribution).scatter(-1, topk_idx, topk_vals)
+    elif routing == 'sequence':
+        weights = pad_mask.unsqueeze(-1).to(gating_distribution.dtype)
+        seq_distribution = (gating_distribution * weights).sum(dim=1) / weights.sum(dim=1).clamp(min=1)
+        topk_vals, topk_idx = seq_distribution.topk(top_k, dim=-1)
+        route = torch.zeros_like(seq_distribution).scatter(-1, topk_idx, topk_vals)
+        route = route.unsqueeze(1).expand_as(gating_distribution)
+    else:
+        raise ValueError(f"unknown routing {routing}, expected 'token' or 'sequence'")
+
+    if capacity_factor is not None:
+        capacity = math.ceil(capacity_factor * batch_size * top_k / num_experts)
+        load = route.sum(dim=1) # B x NUM_EXPERTS
+        rank = torch.argsort(torch.argsort(load, dim=0, descending=True), dim=0)
+        keep = (rank < capacity) & (load > 0)
+        route = route * keep.unsqueeze(1)
+
+    return route / route.sum(dim=-1, keepdim=True).clamp(min=1e-9)
+
+def skip_experts(route, pad_mask, threshold):
+    """ Drop, per sequence, the experts whose routing weight stays below `threshold` at every non-pad position and
+    renormalize the rest. An expert that runs on a sequence keeps its weight at every position, and every non-pad
+    position keeps its largest expert, so no position is left without experts.
+    """
+    peak = (route * pad_mask.unsqueeze(-1)).amax(dim=1, keepdim=True) # B x 1 x NUM_EXPERTS
+    keep = (peak >= threshold) | ((route == route.amax(dim=-1, keepdim=True)) & pad_mask.unsqueeze(-1))
+    route = route * keep
+    return route / route.sum(dim=-1, keepdim=True).clamp(min=1e-9)
+
+def load_balancing_loss(gating_distribution, route, pad_mask):
+    """ Switch transformer auxiliary loss, NUM_EXPERTS * sum(routed fraction * mean gating probability), 1.0 when balanced """
+    num_experts = gating_distribution.size(-1)
+    weights = pad_mask.unsqueeze(-1).to(gating_distribution.dtype)
+    importance = (gating_distribution * weights).sum(dim=(0, 1)) / weights.sum().clamp(min=1)
+    load = ((route > 0).to(gating_distribution.dtype) * weights).sum(dim=(0, 1))
+    load = load / load.sum().clamp(min=1)
+    return num_experts * torch.sum(importance * load)
+
+class ExpertMixture(nn.Module):
+    """ Gating and expert routing shared by the mixture of experts models.
+
+    Subclasses build `experts` and `gating_network` and may override `encode`, which returns the batch-first
+    tensors that every expert and the gating network are called with.
+    """
+
+    def __init__(self, tokenizer, num_experts, top_k=None, routing='token', capacity_factor=None, execution='loop', expert_ids=None, skip_threshold=None, combine='weighted'):
         super().__init__()
         self.tokenizer = tokenizer
-        self.experts = nn.ModuleList([MultitaskTransformer(tokenizer) for _ in range(num_experts)])
-        self.gating_network = MultitaskTransformer(tokenizer, hdim, output_size=num_experts)
+        # the gating network scores `gating_size` experts, pruned models only build and route to `expert_ids`
+        self.gating_size = num_experts
+        self.expert_ids = list(range(num_experts)) if expert_ids is None else list(expert_ids)
+        self.num_experts = len(self.expert_ids)
+        self.top_k = top_k
+        self.routing = routing
+        self.capacity_factor = capacity_factor
+        self.execution = execution
+        self.skip_threshold = skip_threshold
+        if combine not in ('weighted', 'sum'):
+            raise ValueError(f"unknown combine {combine}, expected 'weighted' or 'sum'")
+        # 'weighted' sums the routed expert logits with their gating weights. 'sum' adds them with unit weight, as every
+        # MoE trained before routing did, their gating networks never got a gradient and only load correctly this way
+        self.combine = combine
+        self.checkpointing = None
+        self._stacked_parameters = None
+
+    def config(self):
+        return {"num_experts": self.gating_size, "top_k": self.top_k, "routing": self.routing,
+                "capacity_factor": self.capacity_factor, "execution": self.execution,
+                "expert_ids": self.expert_ids if self.is_pruned() else None, "skip_threshold": self.skip_threshold,
+                "combine": self.combine}
+
+    def is_sparse(self):
+        return self.top_k is not None and self.top_k < self.num_experts
+
+    def is_pruned(self):
+        return self.num_experts < self.gating_size
+
+    def is_skipping(self):
+        "eval mode with a skip_threshold, experts below it are not evaluated, see skip_experts"
+        return self.skip_threshold is not None and not self.training
+
+    def gating_scores(self, *expert_inputs):
+        "gating logits over the built experts, pruned experts are dropped before the softmax so the gating renormalizes over the rest"
+        gating_scores = self._checkpointed(self.gating_network, *expert_inputs) if self.checkpointing == 'expert' else self.gating_network(*expert_inputs)
+        return gating_scores[..., self.expert_ids] if self.is_pruned() else gating_scores
+
+    def prune(self, keep):
+        """ Returns a copy with only the experts at positions `keep`. The gating network is kept whole and its scores for the
+        dropped experts are removed before the softmax, so the kept experts get the same relative weights as before. """
+        keep = sorted(keep)
+        config = {**self.config(), "expert_ids": [self.expert_ids[i] for i in keep]}
+        pruned = type(self)(self.tokenizer, **config)
+
+        state_dict = {name: value for name, value in self.state_dict().items() if not name.startswith('experts.')}
+        for position, i in enumerate(keep):
+            state_dict.update({f'experts.{position}.{name}': value for name, value in self.experts[i].state_dict().items()})
+        pruned.load_state_dict(state_dict)
+        return pruned.to(next(self.parameters()).device).train(self.training)
+
+    def set_checkpointing(self, checkpointing):
+        """ Trade compute for activation memory in training. 'expert' recomputes every expert and the gating network in
+        backward and accumulates the routed outputs without keeping the NUM_EXPERTS x B x SEQUENCE x TOKENS stack,
+        'layer' recomputes every transformer layer. Fused execution checkpoints the whole fused computation in either mode. """
+        if checkpointing not in (None, 'expert', 'layer'):
+            raise ValueError(f"unknown checkpointing {checkpointing}, expected None, 'expert' or 'layer'")
+        self.checkpointing = checkpointing
+        for module in [*self.experts, self.gating_network]:
+            module.set_checkpointing('layer' if checkpointing == 'layer' else None)
+        return self
+
+    def _checkpointed(self, fn, *args):
+        if self.checkpointing is not None and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(fn, *args, use_reentrant=False)
+        return fn(*args)
+
+    def encode(self, input, teach_forcing):
+        return input, teach_forcing
+
+    def forward(self, input, teach_forcing, return_aux_loss=False):
+        expert_inputs = self.encode(input, teach_forcing)
+
+        # Step 1: gating distribution over experts for every output position N x SEQUENCE x NUM_EXPERTS
+        gating_scores = self.gating_scores(*expert_inputs)
+        gating_distribution = F.softmax(gating_scores, dim=-1)
+        pad_mask = teach_forcing != self.tokenizer.PAD_IDX
+
+        # Step 2: dense experts weight every expert, sparse or skipping experts only run on the sequences routed to them
+        # fused execution always evaluates all experts in one batched computation and applies the routing weights after
+        # capacity only balances the training load, at inference every sequence keeps all of its top_k experts
+        capacity_factor = self.capacity_factor if self.training else None
+        route = route_top_k(gating_distribution, pad_mask, self.top_k, self.routing, capacity_factor) if self.is_sparse() else gating_distribution
+        if self.is_skipping():
+            route = skip_experts(route, pad_mask, self.skip_threshold)
+        if self.combine == 'sum':
+            route = (route > 0).to(route.dtype)
+        if (self.is_sparse() or self.is_skipping()) and self.execution == 'loop':
+            combined_output = self._sparse_forward(expert_inputs, route)
+        elif self.execution == 'loop' and self.checkpointing == 'expert' and torch.is_grad_enabled():
+            combined_output = sum(self._routed_expert_output(expert, route[:, :, i], *expert_inputs) for i, expert in enumerate(self.experts))
+        elif self.execution == 'fused' and self.checkpointing is not None:
+            combine = lambda route, *expert_inputs: torch.einsum('ebsv,bse->bsv', self._expert_outputs(expert_inputs), route)
+            combined_output = self._checkpointed(combine, route, *expert_inputs)
+        else:
+            stacked_outputs = self._expert_outputs(expert_inputs) # NUM_EXPERTS x B x SEQUENCE x TOKENS
+            combined_output = torch.einsum('ebsv,bse->bsv', stacked_outputs, route)
+
+        if return_aux_loss:
+            return combined_output, load_balancing_loss(gating_distribution, route, pad_mask)
+        return combined_output
+
+    def _expert_outputs(self, expert_inputs):
+        if self.execution == 'loop':
+            return torch.stack([expert(*expert_inputs) for expert in self.experts], dim=0)
+        if self.execution == 'fused':
+            return self._fused_outputs(self._stacked_expert_parameters(), expert_inputs)
+        raise ValueError(f"unknown execution {self.execution}, expected 'loop' or 'fused'")
+
+    def _stacked_expert_parameters(self):
+        # with gradients the stack is rebuilt every call so the expert parameters stay the leaves,
+        # without gradients it is built once and the experts are re-pointed at its slices
+        if torch.is_grad_enabled():
+            return fused.stack_parameters(self.experts)
+
+        if self._stacked_parameters is None or not fused.shares_stacked_storage(self.experts, self._stacked_parameters):
+            self._stacked_parameters = fused.share_stacked_storage(self.experts, fused.stack_parameters(self.experts))
+        return self._stacked_parameters
+
+    def _sparse_forward(self, expert_inputs, route):
+        batch_size, seq_len, _ = route.shape
+        combined_output = route.new_zeros((batch_size, seq_len, self.tokenizer.vocab_size))
+
+        for i, expert in enumerate(self.experts):
+            routed = torch.nonzero(route[:, :, i].amax(dim=1) > 0).squeeze(1)
+            if routed.numel() == 0:
+                continue
+
+            expert_output = self._routed_expert_output(expert, route[routed, :, i], *[x[routed] for x in expert_inputs])
+            combined_output = combined_output.index_add(0, routed, expert_output)
 
-    def forward(self, input, teach_forcing):
-        # Assuming input is already the output of some layer or initial embedding
-        # You might want to adapt this to your actual input processing
-        
-        # Step 1: Calculate the outputs from each expert B x SEQUENCE x TOKENS
-        expert_outputs = [expert(input, teach_forcing) for expert in self.experts]
-        
-        # Step 2: Stack outputs for gating NUM_EXPERTS x B x SEQUENCE x TOKENS
-        stacked_outputs = torch.stack(expert_outputs, dim=0)
-        
-        # Step 3: Use the last output to decide gating (simple version)
-        gating_scores = self.gating_network(input,teach_forcing)
-        gating_distribution = F.softmax(gating_scores, dim=-1) # N X SEQUENCE X NUM_EXPERTS
-        
-        # Step 4: Combine outputs from all experts based on gating distribution
-        combined_output = torch.einsum('ebsv,bsg->bsv', stacked_outputs, gating_distribution)
         return combined_output
-    
-    def save(self, path):
+
+    def _routed_expert_output(self, expert, weights, *expert_inputs):
+        "expert logits scaled by its B x SEQUENCE routing weights, recomputed in backward with expert checkpointing"
+        routed_output = lambda weights, *expert_inputs: expert(*expert_inputs) * weights.unsqueeze(-1)
+        if self.checkpointing == 'expert':
+            return self._checkpointed(routed_output, weights, *expert_inputs)
+        return routed_output(weights, *expert_inputs)
+
+    def save(self, path, sharded=False):
+        """ Save the tokenizer, config and weights. With `sharded` every expert is written to its own experts/expert_{id}.pt
+        next to a shared.pt with the gating network and any shared layers, listed in manifest.json, so that loading can map
+        only the shards it needs. Otherwise all weights go to a single mtransformer.pt. """
         if not isinstance(path, pathlib.Path):
             path = pathlib.Path(path)
-        
+
         cvae.utils.mk_empty_directory(path, overwrite=True)
         cvae.utils.mk_empty_directory(path / "spvt_tokenizer", overwrite=True)
         self.tokenizer.save(path / "spvt_tokenizer")
-        torch.save(self.state_dict(), path / "mtransformer.pt")
+        with open(path / self.config_file, "w") as file:
+            json.dump(self.config(), file)
+
+        if not sharded:
+            torch.save(self.state_dict(), path / "mtransformer.pt")
+            return path
+
+        # after a fused no_grad forward the expert parameters are views into one stacked tensor, and torch.save writes
+        # the whole storage behind a view, so every shard is cloned into storage of its own
+        cvae.utils.mk_empty_directory(path / "experts", overwrite=True)
+        manifest = {"format": "sharded", "shared": "shared.pt", "experts": {}}
+        torch.save({name: value.clone() for name, value in self.state_dict().items() if not name.startswith('experts.')}, path / manifest["shared"])
+        for expert_id, expert in zip(self.expert_ids, self.experts):
+            manifest["experts"][str(expert_id)] = f"experts/expert_{expert_id}.pt"
+            torch.save({name: value.clone() for name, value in expert.state_dict().items()}, path / manifest["experts"][str(expert_id)])
+        with open(path / "manifest.json", "w") as file:
+            json.dump(manifest, file)
         return path
-    
-    @staticmethod
-    def load(dirpath = pathlib.Path("brick/mtransform1")):
+
+    @classmethod
+    def from_checkpoint(cls, dirpath, **config):
+        """ Load a checkpoint written by `save`, sharded or not. Weights are memory mapped and assigned to a model built on
+        the meta device, so nothing is read or initialized until it is used. Pass `expert_ids` to load only those experts,
+        the gating network is renormalized over them as in `prune`. """
         dirpath = pathlib.Path(dirpath)
         tokenizer = SelfiesPropertyValTokenizer.load(dirpath / "spvt_tokenizer")
-        model = MoE(tokenizer)
-        model.load_state_dict(torch.load(dirpath / 'mtransformer.pt'))
+        saved_config = cls.load_config(dirpath)
+        with torch.device('meta'):
+            model = cls(tokenizer, **{**saved_config, **config})
+
+        load = lambda path: torch.load(path, mmap=True, weights_only=True)
+        manifest_path = dirpath / "manifest.json"
+        if manifest_path.exists():
+            with open(manifest_path, "r") as file:
+                manifest = json.load(file)
+            state_dict = load(dirpath / manifest["shared"])
+            expert_state_dict = lambda expert_id: load(dirpath / manifest["experts"][str(expert_id)])
+        else:
+            # monolithic checkpoints number their experts by position among the saved expert_ids
+            state_dict = load(dirpath / "mtransformer.pt")
+            saved_ids = saved_config.get("expert_ids") or list(range(model.gating_size))
+            def expert_state_dict(expert_id):
+                prefix = f'experts.{saved_ids.index(expert_id)}.'
+                return {name[len(prefix):]: value for name, value in state_dict.items() if name.startswith(prefix)}
+
+        shared_state_dict = {name: value for name, value in state_dict.items() if not name.startswith('experts.')}
+        for position, expert_id in enumerate(model.expert_ids):
+            shared_state_dict.update({f'experts.{position}.{name}': value for name, value in expert_state_dict(expert_id).items()})
+        model.load_state_dict(shared_state_dict, assign=True)
         model.eval()
-        return model
\ No newline at end of file
+        return model
+
+    @classmethod
+    def load_config(cls, dirpath):
+        """ returns the saved configuration. MoE checkpoints written before moe_config.json existed are dense and
+        summed their experts with unit weight, they load with combine='sum' """
+        config_path = pathlib.Path(dirpath) / cls.config_file
+        if not config_path.exists():
+            return {"combine": "sum"}
+        with open(config_path, "r") as file:
+            return json.load(file)
+
+class MoE(ExpertMixture):
+
+    config_file = "moe_config.json"
+
+    def __init__(self, tokenizer, num_experts=8, hdim=256, top_k=None, routing='token', capacity_factor=None, execution='loop', expert_ids=None, skip_threshold=None, combine='weighted'):
+        super().__init__(tokenizer, num_experts, top_k, routing, capacity_factor, execution, expert_ids, skip_threshold, combine)
+        self.hdim = hdim
+        self.experts = nn.ModuleList([MultitaskTransformer(tokenizer) for _ in range(self.num_experts)])
+        self.gating_network = MultitaskTransformer(tokenizer, hdim, output_size=num_experts)
+
+    def config(self):
+        return {**super().config(), "hdim": self.hdim}
+
+    def _fused_outputs(self, params, expert_inputs):
+        return fused.fused_forward(self.experts[0], params, *expert_inputs)
+
+    @staticmethod
+    def load(dirpath = pathlib.Path("brick/mtransform1"), **config):
+        return MoE.from_checkpoint(dirpath, **config)
+
+class ExpertDecoder(nn.Module):
+    """ The decoder, decoder_norm and classification_layers of a MultitaskTransformer, run on an embedded
+    teach forcing sequence and a memory computed elsewhere. Parameter names match MultitaskTransformer. """
+
+    def __init__(self, output_size, hdim=512, nhead=4, num_layers=4, dim_feedforward=512, dropout_rate=0.1):
+        super().__init__()
+        self.output_size = output_size
+        self.hdim = hdim
+        self.nhead = nhead
+
+        decode_args = {"d_model": self.hdim, "nhead": self.nhead, "dim_feedforward": dim_feedforward, "dropout": dropout_rate}
+        decode_layer = nn.TransformerDecoderLayer(**decode_args, batch_first=True)
+        self.decoder = nn.TransformerDecoder(decode_layer, num_layers=num_layers)
+        self.decoder_norm = nn.LayerNorm(self.hdim)
+        self.checkpointing = None
+
+        self.classification_layers = nn.Sequential(
+            nn.Linear(self.hdim, self.output_size),
+            nn.LeakyReLU(),
+            nn.Linear(self.output_size, self.output_size),
+            nn.LeakyReLU(),
+            nn.Linear(self.output_size, self.output_size)
+        )
+
+    def forward(self, teach_embedding, memory, memory_mask):
+        tgt_mask = generate_custom_subsequent_mask(teach_embedding.size(1)).to(memory.device)
+        decoded = run_transformer_stack(self.decoder, teach_embedding, memory, tgt_mask=tgt_mask, memory_key_padding_mask=memory_mask, checkpoint_layers=self.checkpointing == 'layer')
+        return self.classification_layers(self.decoder_norm(decoded))
+
+    def set_checkpointing(self, checkpointing):
+        self.checkpointing = checkpointing
+        return self
+
+class SharedEncoderMoE(ExpertMixture):
+    """ Mixture of experts where a single embedding and selfies encoder produce the memory for every expert.
+    Only the decoders and classification heads are expert specific, so the input is encoded once instead of once per expert. """
+
+    config_file = "shared_encoder_moe_config.json"
+
+    def __init__(self, tokenizer, num_experts=8, hdim=512, nhead=4, num_layers=4, dim_feedforward=512, dropout_rate=0.1,
+                 top_k=None, routing='token', capacity_factor=None, execution='loop', expert_ids=None, skip_threshold=None, combine='weighted'):
+        super().__init__(tokenizer, num_experts, top_k, routing, capacity_factor, execution, expert_ids, skip_threshold, combine)
+        self.hdim = hdim
+        self.nhead = nhead
+        self.num_layers = num_layers
+        self.dim_feedforward = dim_feedforward
+        self.dropout_rate = dropout_rate
+        self.token_pad_idx = tokenizer.PAD_IDX
+
+        self.embedding = nn.Embedding(tokenizer.vocab_size, self.hdim)
+        self.positional_encoding = PositionalEncoding(self.hdim)
+
+        encode_args = {"d_model": self.hdim, "nhead": self.nhead, "dim_feedforward": self.dim_feedforward, "dropout": dropout_rate}
+        encode_layer = nn.TransformerEncoderLayer(**encode_args, batch_first=True)
+        self.encoder = nn.TransformerEncoder(encode_layer, num_layers=num_layers)
+
+        decode_args = {"hdim": hdim, "nhead": nhead, "num_layers": num_layers, "dim_feedforward": dim_feedforward, "dropout_rate": dropout_rate}
+        self.experts = nn.ModuleList([ExpertDecoder(tokenizer.vocab_size, **decode_args) for _ in range(self.num_experts)])
+        self.gating_network = ExpertDecoder(num_experts, **decode_args)
+
+    def config(self):
+        return {**super().config(), "hdim": self.hdim, "nhead": self.nhead, "num_layers": self.num_layers,
+                "dim_feedforward": self.dim_feedforward, "dropout_rate": self.dropout_rate}
+
+    def encode(self, input, teach_forcing):
+        memory_mask = input == self.token_pad_idx
+        memory = run_transformer_stack(self.encoder, self.positional_encoding(self.embedding(input)), src_key_padding_mask=memory_mask, checkpoint_layers=self.checkpointing == 'layer')
+        teach_embedding = self.positional_encoding(self.embedding(teach_forcing))
+        return teach_embedding, memory, memory_mask
+
+    def _fused_outputs(self, params, expert_inputs):
+        teach_embedding, memory, memory_mask = expert_inputs
+        expand = lambda x: x.unsqueeze(0).expand(self.num_experts, *x.shape)
+        return fused.fused_decode(self.experts[0], params, expand(teach_embedding), expand(memory), memory_mask)
+
+    @staticmethod
+    def from_moe(moe, encoder_expert=0):
+        """ Initialize a SharedEncoderMoE from a trained MoE. The embedding and encoder come from `encoder_expert`,
+        every expert keeps its own decoder and head. The gating network starts untrained, fine tune with distillation from `moe`. """
+        model = SharedEncoderMoE(moe.tokenizer, **{k: v for k, v in moe.config().items() if k != 'hdim'})
+
+        source = moe.experts[encoder_expert]
+        model.embedding.load_state_dict(source.embedding.state_dict())
+        model.encoder.load_state_dict(source.encoder.state_dict())
+
+        for expert, decoder in zip(moe.experts, model.experts):
+            decoder.decoder.load_state_dict(expert.decoder.state_dict())
+            decoder.decoder_norm.load_state_dict(expert.decoder_norm.state_dict())
+            decoder.classification_layers.load_state_dict(expert.classification_layers.state_dict())
+
+        return model
+
+    @staticmethod
+    def load(dirpath = pathlib.Path("brick/moe_shared"), **config):
+        return SharedEncoderMoE.from_checkpoint(dirpath, **config)
+
+def load_model(dirpath, **config):
+    "loads the MoE, SharedEncoderMoE or MultitaskTransformer saved in dirpath, directories without a config file hold a MoE"
+    dirpath = pathlib.Path(dirpath)
+    if (dirpath / MultitaskTransformer.config_file).exists():
+        return MultitaskTransformer.load(dirpath)
+    if (dirpath / SharedEncoderMoE.config_file).exists():
+        return SharedEncoderMoE.load(dirpath, **config)
+    return MoE.load(dirpath, **config)
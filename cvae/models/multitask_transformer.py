@@ -3,9 +3,17 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch, torch.nn as nn, torch.nn.functional as F
 import torch.utils.data
+import torch.utils.checkpoint
 import math
+import random
+import json
 import pathlib
+import collections
+import itertools
+import queue
+import threading
 import tqdm
+import numpy as np
 
 from cvae.tokenizer.selfies_property_val_tokenizer import SelfiesPropertyValTokenizer
 import cvae.utils
@@ -58,8 +66,34 @@ def generate_static_mask(selfies_sz: int, assayval_sz:int) -> torch.Tensor:
     
     return mask
     
+def trim_padding(input: torch.Tensor, pad_idx: int) -> torch.Tensor:
+    """ Drop the trailing selfies columns that are padding in every row of the batch.
+
+    Padded keys are masked and padded queries only ever reach masked keys, so the outputs are unchanged while attention,
+    feedforward and cross attention cost scale with the longest molecule in the batch instead of the tokenizer pad length.
+    This is batch level trimming, not packed varlen attention: one long molecule keeps the whole batch wide, so it pays
+    off with batches of similar lengths from BucketBatchSampler. Reading the length is a host sync on device tensors,
+    call it on host batches as SequenceShiftDataset.collate and the flask Predictor do, the models don't trim.
+    Skipped when tracing or compiling, where the data dependent length would be frozen into the graph.
+    """
+    if torch.jit.is_tracing() or torch.compiler.is_compiling():
+        return input
+    columns = (input != pad_idx).any(dim=0).nonzero()
+    length = int(columns.max()) + 1 if len(columns) > 0 else 1
+    return input[:, :length]
+
+def run_transformer_stack(stack, x, *args, checkpoint_layers=False, **kwargs):
+    "run an nn.TransformerEncoder or nn.TransformerDecoder, with checkpoint_layers every layer is recomputed in backward instead of keeping its activations"
+    if not (checkpoint_layers and torch.is_grad_enabled()):
+        return stack(x, *args, **kwargs)
+    for layer in stack.layers:
+        x = torch.utils.checkpoint.checkpoint(layer, x, *args, use_reentrant=False, **kwargs)
+    return x if stack.norm is None else stack.norm(x)
+
 class MultitaskTransformer(nn.Module):
     
+    config_file = "mtransformer_config.json"
+    
     def __init__(self, tokenizer, hdim=512, nhead=4, num_layers=4, dim_feedforward=512, dropout_rate=0.1, output_size=None):
         
         super().__init__()
@@ -67,9 +101,12 @@ class MultitaskTransformer(nn.Module):
         self.output_size = tokenizer.vocab_size if output_size is None else output_size
         self.hdim = hdim
         self.nhead = nhead
+        self.num_layers = num_layers
         self.dim_feedforward = dim_feedforward
+        self.dropout_rate = dropout_rate
         self.tokenizer = tokenizer
         self.token_pad_idx = tokenizer.PAD_IDX
+        self.checkpointing = None
         
         self.embedding = nn.Embedding(tokenizer.vocab_size, self.hdim)
         self.positional_encoding = PositionalEncoding(self.hdim)
@@ -92,30 +129,72 @@ class MultitaskTransformer(nn.Module):
         )
 
 
-    def forward(self, input, teach_forcing):
-        
+    def encode(self, input):
+        "returns the encoded selfies memory and its padding mask, inputs are trimmed on the host by collate"
         memory_mask = input == self.token_pad_idx
-        
+
         input_embedding = self.positional_encoding(self.embedding(input))
-        input_encoding = self.encoder(input_embedding, src_key_padding_mask=memory_mask)
-        
+        input_encoding = run_transformer_stack(self.encoder, input_embedding, src_key_padding_mask=memory_mask, checkpoint_layers=self.checkpointing == 'layer')
+        return input_encoding, memory_mask
+
+    def decode(self, teach_forcing, memory, memory_mask):
+        "returns the logits for every teach forcing position given an encoded memory"
         teach_forcing = self.positional_encoding(self.embedding(teach_forcing))
-        tgt_mask = generate_custom_subsequent_mask(teach_forcing.size(1)).to(input.device)
-        
-        decoded = self.decoder(teach_forcing, input_encoding, tgt_mask=tgt_mask, memory_key_padding_mask=memory_mask)
+        tgt_mask = generate_custom_subsequent_mask(teach_forcing.size(1)).to(memory.device)
+
+        decoded = run_transformer_stack(self.decoder, teach_forcing, memory, tgt_mask=tgt_mask, memory_key_padding_mask=memory_mask, checkpoint_layers=self.checkpointing == 'layer')
         decoded = self.decoder_norm(decoded)
-        
+
         logits = self.classification_layers(decoded)
-        
+
         return logits
-    
+
+    def forward(self, input, teach_forcing):
+        memory, memory_mask = self.encode(input)
+        return self.decode(teach_forcing, memory, memory_mask)
+
+    def set_checkpointing(self, checkpointing):
+        "None or 'layer' to recompute every encoder and decoder layer in backward, trading compute for activation memory"
+        if checkpointing not in (None, 'layer'):
+            raise ValueError(f"unknown checkpointing {checkpointing}, expected None or 'layer'")
+        self.checkpointing = checkpointing
+        return self
+
     @staticmethod
     def lossfn(ignore_index = -100, weight_decay=1e-5):
         ce_lossfn = nn.CrossEntropyLoss(reduction='mean', ignore_index=ignore_index, label_smoothing=0.05)
         def lossfn(parameters, logits, output):
             ce_loss = ce_lossfn(logits, output)
             return ce_loss
-        return lossfn   
+        return lossfn
+
+    @staticmethod
+    def distillation_lossfn(ignore_index = -100, temperature=2.0, alpha=0.5, value_indexes=None):
+        """ Cross entropy on the labels mixed with the KL divergence to a teacher's temperature softened distribution.
+
+        The returned function takes B x SEQUENCE x TOKENS student and teacher logits, positions whose output is ignore_index are skipped.
+        With `value_indexes` the KL term only uses the positions that predict a value token and the distribution over the value tokens.
+        """
+        ce_lossfn = nn.CrossEntropyLoss(reduction='mean', ignore_index=ignore_index, label_smoothing=0.05)
+        def lossfn(logits, teacher_logits, output):
+            ce_loss = ce_lossfn(logits.permute(0, 2, 1), output)
+
+            if value_indexes is None:
+                keep = output != ignore_index
+                logits, teacher_logits = logits[keep], teacher_logits[keep]
+            else:
+                keep = torch.isin(output, value_indexes)
+                logits, teacher_logits = logits[keep][:, value_indexes], teacher_logits[keep][:, value_indexes]
+
+            if logits.size(0) == 0:
+                return ce_loss
+
+            student_logprob = F.log_softmax(logits / temperature, dim=-1)
+            teacher_logprob = F.log_softmax(teacher_logits / temperature, dim=-1)
+            kl_loss = F.kl_div(student_logprob, teacher_logprob, log_target=True, reduction='batchmean') * temperature ** 2
+
+            return alpha * ce_loss + (1 - alpha) * kl_loss
+        return lossfn
     
     def save(self, path):
         if not isinstance(path, pathlib.Path):
@@ -125,17 +204,83 @@ class MultitaskTransformer(nn.Module):
         cvae.utils.mk_empty_directory(path / "spvt_tokenizer", overwrite=True)
         self.tokenizer.save(path / "spvt_tokenizer")
         torch.save(self.state_dict(), path / "mtransformer.pt")
+        with open(path / MultitaskTransformer.config_file, "w") as file:
+            json.dump(self.config(), file)
         return path
-    
+
+    def config(self):
+        return {"hdim": self.hdim, "nhead": self.nhead, "num_layers": self.num_layers, "dim_feedforward": self.dim_feedforward,
+                "dropout_rate": self.dropout_rate, "output_size": self.output_size}
+
     @staticmethod
     def load(dirpath = pathlib.Path("brick/mtransform1")):
         dirpath = pathlib.Path(dirpath)
         tokenizer = SelfiesPropertyValTokenizer.load(dirpath / "spvt_tokenizer")
-        model = MultitaskTransformer(tokenizer)
+        config = {}
+        if (dirpath / MultitaskTransformer.config_file).exists():
+            with open(dirpath / MultitaskTransformer.config_file, "r") as file:
+                config = json.load(file)
+        model = MultitaskTransformer(tokenizer, **config)
         model.load_state_dict(torch.load(dirpath / 'mtransformer.pt'))
         model.eval()
         return model
 
+def shift_assay_vals(assay_vals, nprops, pad_idx, sep_idx, end_idx, generator=None):
+    """ teach forcing and output tokens for a B x WIDTH batch of right padded assay values, on assay_vals' device.
+
+    Every row of assay_vals is [SEP, assay, value, ..., END, PAD, ...]. The assay value pairs of each row are shuffled
+    by sorting random keys drawn from generator, truncated to nprops pairs and wrapped in SEP/END tokens padded to nprops*2+2.
+    """
+    batch_size, device = assay_vals.size(0), assay_vals.device
+
+    # assay_val munging - unpad, randomly permute with padded pairs sorted last
+    npairs = (((assay_vals != pad_idx).sum(dim=1) - 2) // 2).clamp(min=0)
+    max_pairs = max(int(npairs.max()), 1)
+    pairs = F.pad(assay_vals[:, 1:], (0, max(0, 2 * max_pairs + 1 - assay_vals.size(1))), value=pad_idx)
+    pairs = pairs[:, :2 * max_pairs].reshape(batch_size, max_pairs, 2)
+    keys = torch.rand(batch_size, max_pairs, device=device, generator=generator)
+    keys = keys.masked_fill(torch.arange(max_pairs, device=device) >= npairs.unsqueeze(1), float('inf'))
+    order = keys.argsort(dim=1)[:, :nprops]
+    av_truncate = pairs.gather(1, order.unsqueeze(-1).expand(-1, -1, 2)).reshape(batch_size, -1)
+
+    # truncate to nprops random features, add start and end tokens and pad to nprops*2+2
+    nvals = 2 * npairs.clamp(max=nprops).unsqueeze(1)
+    position = torch.arange(nprops * 2 + 2, device=device).unsqueeze(0)
+    av_truncate = F.pad(av_truncate, (1, nprops * 2 + 1 - av_truncate.size(1)), value=pad_idx)
+    out = torch.where(position <= nvals, av_truncate, pad_idx)
+    out = out.masked_fill(position == 0, sep_idx).masked_fill(position == nvals + 1, end_idx)
+
+    tch = torch.cat([torch.ones(batch_size, 1, dtype=out.dtype, device=device), out[:, :-1]], dim=1)
+    return tch, out
+
+def token_dtype(vocab_size):
+    "smallest integer dtype holding every token index, the shards of 2_build_tensordataset are stored with it"
+    return torch.int16 if vocab_size <= torch.iinfo(torch.int16).max + 1 else torch.int32
+
+def load_shard(path, pad_idx):
+    """ selfies, assay values and assay value row offsets of a shard from 2_build_tensordataset.
+
+    Assay values are stored CSR style, every chemical's [SEP, assay, value, ..., END] tokens concatenated with
+    assay_val_offsets holding the start of every chemical plus the end of the last one. Shards written before this
+    layout hold right padded assay values and are compacted on load.
+    """
+    file_data = torch.load(path)
+    if 'assay_val_offsets' in file_data:
+        return file_data['selfies'], file_data['assay_vals'], file_data['assay_val_offsets']
+    padded = file_data['assay_vals']
+    lengths = _trailing_padding_lengths(padded, pad_idx)
+    keep = torch.arange(padded.size(1)).unsqueeze(0) < lengths.unsqueeze(1)
+    return file_data['selfies'], padded[keep], F.pad(torch.cumsum(lengths, dim=0), (1, 0))
+
+def _gather_rows(tokens, offsets, indices, width, pad_idx):
+    "B x width right padded long rows of CSR numpy tokens, read with a single fancy index"
+    starts, ends = offsets[indices], offsets[indices + 1]
+    position = np.arange(width)
+    keep = position < (ends - starts)[:, None]
+    rows = np.full((len(indices), width), pad_idx, dtype=np.int64)
+    rows[keep] = tokens[(starts[:, None] + position)[keep]]
+    return torch.from_numpy(rows)
+
 class SequenceShiftDataset(torch.utils.data.Dataset):
 
     def __init__(self, path, tokenizer: SelfiesPropertyValTokenizer, nprops=5, assay_filter=[]):
@@ -150,53 +295,528 @@ class SequenceShiftDataset(torch.utils.data.Dataset):
 
         # file_path = next(pathlib.Path(path).glob("*.pt"))
         for file_path in tqdm.tqdm(pathlib.Path(path).glob("*.pt")):
-            file_data = torch.load(file_path)
+            selfies, assay_vals, assay_val_offsets = load_shard(file_path, self.pad_idx)
             
-            # num_props = file_data['assay_vals'].size(1)
-            # assay_vals = file_data['assay_vals'][num_props > 9]
-            self.data.extend([(file_data['selfies'], file_data['assay_vals'])])
-            cumulative_length += file_data['selfies'].size(0)
+            # assay values stay CSR, rows are sliced straight out of the flat arrays
+            self.data.extend([(selfies, assay_vals.numpy(), assay_val_offsets.numpy())])
+            cumulative_length += selfies.size(0)
             self.cumulative_lengths.append(cumulative_length)
 
+        # file start offsets, a global index is resolved with a binary search
+        self.cumulative_lengths = np.array(self.cumulative_lengths, dtype=np.int64)
+
     def __len__(self):
-        return self.cumulative_lengths[-1] if self.cumulative_lengths else 0
+        return int(self.cumulative_lengths[-1])
+
+    def _locate(self, idx):
+        "file index and index within that file for a global index or an array of them"
+        file_idx = np.searchsorted(self.cumulative_lengths, idx, side='right') - 1
+        return file_idx, idx - self.cumulative_lengths[file_idx]
+
+    raw = False
+
+    def set_raw(self, raw):
+        """ with raw set the dataset returns (selfies, padded assay values) instead of (selfies, teach forcing, output),
+        for building the teach forcing and outputs on the device with cvae.models.augmentation.BatchAugmentation """
+        self.raw = raw
+        return self
+
+    def collate(self, batch):
+        """ DataLoader collate_fn that trims the selfies to the longest molecule in the batch. Batches built by
+        __getitems__ are already stacked, lists of __getitem__ samples are stacked first."""
+        if not isinstance(batch, tuple):
+            batch = torch.utils.data.default_collate(batch) if not self.raw else \
+                (torch.stack([selfies for selfies, _ in batch]), torch.nn.utils.rnn.pad_sequence([assay_vals for _, assay_vals in batch], batch_first=True, padding_value=self.pad_idx))
+        inp, *targets = batch
+        return trim_padding(inp, self.pad_idx), *targets
+
+    def collate_trimmed(self, batch):
+        """ collate that also drops the teach forcing and output columns that are padding in every row, for training with
+        BucketBatchSampler. Evaluation expects the full nprops*2+2 outputs and uses collate."""
+        inp, tch, out = self.collate(batch)
+        out = trim_padding(out, self.pad_idx)
+        return inp, tch[:, :out.size(1)], out
+
+    def sample_lengths(self):
+        "selfies length and number of assay value pairs of every chemical, used by BucketBatchSampler"
+        selfies_lengths = torch.cat([_trailing_padding_lengths(selfies, self.pad_idx) for selfies, _, _ in self.data])
+        assay_val_lengths = np.concatenate([np.diff(assay_val_offsets) for _, _, assay_val_offsets in self.data])
+        return selfies_lengths.numpy(), ((assay_val_lengths - 2) // 2).clip(min=0)
 
     def __getitem__(self, idx):
-        
-        # Find which section this index falls into and update the index to be relative to that section
-        file_idx = next(i for i, total_length in enumerate(self.cumulative_lengths) if total_length > idx) - 1
-        idx -= self.cumulative_lengths[file_idx]
-        
-        idxdata = self.data[file_idx]
-        selfies_raw, raw_assay_vals = idxdata[0][idx], idxdata[1][idx]
-        
-        # remove padding from selfies
-        # selfies = selfies_raw[selfies_raw != self.pad_idx]
+        return tuple(tokens[0] for tokens in self._shift_batch(*self._raw_batch([idx])))
 
-        # assay_val munging - unpad, randomly permute, add sos/eos tokens
-        assay_vals = raw_assay_vals[raw_assay_vals != self.pad_idx][1:-1]
-        reshaped_av = assay_vals.reshape(assay_vals.size(0) // 2, 2)
-        av_shuffled = reshaped_av[torch.randperm(reshaped_av.size(0)),:].reshape(assay_vals.size(0))
-        
-        # truncate to n_features random features
-        n_features = self.nprops
-        av_truncate = av_shuffled[0:(n_features*2)]
-        
-        # add start and end tokends and pad to 120 length
-        av_sos_eos = torch.cat([torch.LongTensor([self.sep_idx]), av_truncate, torch.LongTensor([self.end_idx])])
-        
-        # add padding up to n_features*2+2
-        out = F.pad(av_sos_eos, (0, (n_features*2+2) - av_sos_eos.size(0)), value=self.pad_idx)
+    def _raw_batch(self, indices):
+        "selfies and right padded assay values of the chemicals at indices, rows are gathered once per file"
+        file_idxs, idxs = self._locate(np.asarray(indices, dtype=np.int64))
+        groups = []
+        for file_idx in np.unique(file_idxs):
+            positions = np.nonzero(file_idxs == file_idx)[0]
+            file_selfies, file_assay_vals, file_offsets = self.data[file_idx]
+            lengths = file_offsets[idxs[positions] + 1] - file_offsets[idxs[positions]]
+            assay_vals = _gather_rows(file_assay_vals, file_offsets, idxs[positions], int(lengths.max()), self.pad_idx)
+            groups.append((torch.from_numpy(positions), file_selfies[torch.from_numpy(idxs[positions])], assay_vals))
 
-        # out = torch.hstack([av_truncate,torch.tensor([self.pad_idx])])
-        tch = torch.hstack([torch.tensor([1]),out[:-1]])
-        
-        # inp = selfies_raw # F.pad(selfies, (0, 119 - selfies.size(0)), value=self.pad_idx)
-        # inp = torch.hstack([selfies, torch.tensor([self.sep_idx]), av_shuffled[2:4]])
-        inp = selfies_raw
-        # pad_inp = F.pad(inp, (0, 126 - inp.size(0)), value=self.pad_idx)
-        
-        return inp, tch, out
+        selfies = torch.empty((len(indices), groups[0][1].size(1)), dtype=torch.long)
+        assay_vals = torch.full((len(indices), max(group[2].size(1) for group in groups)), self.pad_idx, dtype=torch.long)
+        for positions, file_selfies, file_assay_vals in groups:
+            selfies[positions] = file_selfies.long()
+            assay_vals[positions, :file_assay_vals.size(1)] = file_assay_vals
+        return selfies, assay_vals
+
+    def __getitems__(self, indices):
+        """ batched __getitem__ used by the DataLoader, returns the whole batch as stacked (selfies, teach forcing, output)
+        tensors built with batched ops. Use collate as the DataLoader collate_fn. The property shuffle of a SeededBatch
+        from BucketBatchSampler is drawn from its seed, otherwise from the global generator of the worker."""
+        generator = torch.Generator().manual_seed(indices.seed) if isinstance(indices, SeededBatch) else None
+        return self._shift_batch(*self._raw_batch(indices), generator=generator)
+
+    def _shift_batch(self, selfies, assay_vals, generator=None):
+        "builds (selfies, teach forcing, output) for a B x WIDTH batch of selfies and right padded assay values"
+        if self.raw:
+            return selfies, assay_vals
+        tch, out = shift_assay_vals(assay_vals, self.nprops, self.pad_idx, self.sep_idx, self.end_idx, generator=generator)
+        return selfies, tch, out
+
+class SeededBatch(list):
+    "the indices of a batch and the seed of its random draws, DataLoader workers receive it as the sampler yielded it"
+
+    def __init__(self, indices, seed):
+        super().__init__(indices)
+        self.seed = seed
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """ Batch sampler that groups chemicals with similar selfies length and the same number of output properties.
+
+    Chemicals are bucketed by selfies length in steps of selfies_bucket_width and by their assay value pair count capped at
+    nprops, every epoch shuffles the chemicals within each bucket and the order of the batches. With collate_trimmed the
+    batches are then padded only to their own longest selfies and property count.
+
+    For DDP pass rank and world_size, every rank gets the same number of batches. Call set_epoch before each epoch.
+    The batches are a function of seed and epoch, set_start skips straight to a batch when a run is resumed. Batches are
+    yielded as SeededBatch with a seed derived from (seed, epoch, rank, position), so the property shuffles of a batch
+    don't depend on which DataLoader worker builds it or on where the run was started.
+    """
+
+    def __init__(self, selfies_lengths, num_pairs, batch_size, nprops=5, selfies_bucket_width=8, shuffle=True,
+                 drop_last=False, seed=0, rank=0, world_size=1):
+        self.buckets = np.asarray(selfies_lengths) // selfies_bucket_width * (nprops + 1) + np.minimum(num_pairs, nprops)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.rank, self.world_size = rank, world_size
+        self.epoch, self.start = 0, 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start(self, start):
+        "the next iteration begins at batch start of the epoch, without reading the batches before it"
+        self.start = start
+
+    def _batches(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.buckets), generator=generator).numpy() if self.shuffle else np.arange(len(self.buckets))
+        order = order[np.argsort(self.buckets[order], kind='stable')]
+        bucket_starts = np.flatnonzero(np.diff(self.buckets[order], prepend=-1))
+        batches = []
+        for bucket in np.split(order, bucket_starts[1:]):
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size)
+                           if not self.drop_last or i + self.batch_size <= len(bucket))
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+        batches = batches[:len(batches) - len(batches) % self.world_size]
+        return batches[self.rank::self.world_size]
+
+    def _batch_seed(self, position):
+        return int(np.random.SeedSequence([self.seed, self.epoch, self.rank, position]).generate_state(1)[0])
+
+    def __iter__(self):
+        batches = self._batches()
+        return (SeededBatch(batches[i].tolist(), self._batch_seed(i)) for i in range(self.start, len(batches)))
+
+    def __len__(self):
+        sizes = np.unique(self.buckets, return_counts=True)[1]
+        batches = int((sizes // self.batch_size).sum() if self.drop_last else (-(-sizes // self.batch_size)).sum())
+        return batches // self.world_size
+
+class ShuffleBatchSampler(BucketBatchSampler):
+    "shuffled batches of num_samples chemicals with the epoch, start and DDP handling of BucketBatchSampler"
+
+    def __init__(self, num_samples, batch_size, shuffle=True, drop_last=False, seed=0, rank=0, world_size=1):
+        single_bucket = np.zeros(num_samples, dtype=np.int64)
+        super().__init__(single_bucket, single_bucket, batch_size, nprops=0, selfies_bucket_width=1, shuffle=shuffle,
+                         drop_last=drop_last, seed=seed, rank=rank, world_size=world_size)
+
+def rng_state():
+    "python, numpy, torch and cuda generator states of this process"
+    cuda = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    return {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state(), 'cuda': cuda}
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class ResumableLoader():
+    """ Endless (step, batch) iterator over a DataLoader whose batch_sampler is a BucketBatchSampler or ShuffleBatchSampler,
+    or whose dataset is a batched ShardStreamDataset, a resumable replacement for itertools.cycle(enumerate(dataloader)).
+
+    Batches are counted as they are consumed, so prefetching workers do not move the position. state_dict holds the epoch,
+    the batch within it, the global step and the python, numpy and torch generator states of this process, which draw
+    dropout and any masking in the training loop. load_state_dict continues from the next unconsumed batch, whose
+    property shuffles come from its SeededBatch seed:
+
+        trn_iterator = mt.ResumableLoader(trndl)
+        torch.save(trn_iterator.state_dict(), "training_state.pt")
+        trn_iterator.load_state_dict(torch.load("training_state.pt"))
+    """
+
+    def __init__(self, dataloader):
+        self.dataloader = dataloader
+        # whatever decides the batch order and can set_epoch and set_start
+        self.order = dataloader.batch_sampler if dataloader.batch_sampler is not None else dataloader.dataset
+        self.epoch, self.batch, self.step = 0, 0, 0
+        self._iterator = None
+
+    def state_dict(self):
+        return {'epoch': self.epoch, 'batch': self.batch, 'step': self.step, 'seed': self.order.seed, 'rng': rng_state()}
+
+    def load_state_dict(self, state):
+        if state['seed'] != self.order.seed:
+            raise ValueError(f"state was saved with sampler seed {state['seed']}, the sampler has seed {self.order.seed}")
+        self.epoch, self.batch, self.step = state['epoch'], state['batch'], state['step']
+        if 'rng' in state:
+            set_rng_state(state['rng'])
+        self._iterator = None
+        return self
+
+    def _batches(self):
+        while True:
+            self.order.set_epoch(self.epoch)
+            self.order.set_start(self.batch)
+            # worker seeds come from (seed, epoch, batch) instead of a draw from the global generator, so starting the
+            # workers doesn't shift the draws of the training loop and a resumed run reseeds them the same way
+            seed = np.random.SeedSequence([self.order.seed, self.epoch, self.batch]).generate_state(1)[0]
+            self.dataloader.generator = torch.Generator().manual_seed(int(seed))
+            for batch in self.dataloader:
+                step = self.step
+                self.batch, self.step = self.batch + 1, self.step + 1
+                yield step, batch
+            self.epoch, self.batch = self.epoch + 1, 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = self._batches()
+        return next(self._iterator)
+
+class ValidationBundle():
+    """ A fixed validation set, materialized once from a SequenceShiftDataset and iterated without DataLoader workers.
+
+    size chemicals are drawn with a seeded permutation and their property orders with a seeded generator, so every
+    evaluation sees the same batches. Under DDP each rank keeps every world_size-th chemical and the remainder is
+    dropped, so all ranks hold the same number. The tensors can live on the training device or in pinned memory:
+
+        valdl = mt.ValidationBundle.build(valds, size=50000, batch_size=128, rank=rank, world_size=world_size, device=rank)
+        for inp, teach, out in valdl: ...
+    """
+
+    def __init__(self, inp, tch, out, batch_size, pad_idx):
+        self.inp, self.tch, self.out = inp, tch, out
+        self.batch_size = batch_size
+        self.pad_idx = pad_idx
+        # selfies width of every batch, read once on the host so iterating device resident batches doesn't sync
+        lengths = _trailing_padding_lengths(inp.cpu(), pad_idx)
+        self.widths = [max(int(lengths[start:start + batch_size].max()), 1) for start in range(0, inp.size(0), batch_size)]
+
+    @staticmethod
+    def build(dataset, size=None, batch_size=128, seed=0, rank=0, world_size=1, device=None, pin_memory=False):
+        generator = torch.Generator().manual_seed(seed)
+        indices = torch.randperm(len(dataset), generator=generator)[:size]
+        # every rank evaluates the same number of chemicals so DDP ranks run the same number of forwards
+        indices = indices[:len(indices) - len(indices) % world_size][rank::world_size].numpy()
+
+        # built a batch at a time, a heavily measured chemical only widens the assay values of its own batch
+        inp, tch, out = [], [], []
+        for start in tqdm.tqdm(range(0, len(indices), batch_size), desc="validation bundle"):
+            selfies, assay_vals = dataset._raw_batch(indices[start:start + batch_size])
+            teach, output = shift_assay_vals(assay_vals, dataset.nprops, dataset.pad_idx, dataset.sep_idx, dataset.end_idx, generator=generator)
+            inp.append(selfies), tch.append(teach), out.append(output)
+        tensors = [torch.cat(tokens) for tokens in (inp, tch, out)]
+
+        if device is not None:
+            tensors = [tokens.to(device) for tokens in tensors]
+        elif pin_memory:
+            tensors = [tokens.pin_memory() for tokens in tensors]
+        return ValidationBundle(*tensors, batch_size, dataset.pad_idx)
+
+    def __len__(self):
+        return -(-self.inp.size(0) // self.batch_size)
+
+    def __iter__(self):
+        for start, width in zip(range(0, self.inp.size(0), self.batch_size), self.widths):
+            end = start + self.batch_size
+            yield self.inp[start:end, :width], self.tch[start:end], self.out[start:end]
+
+def _trailing_padding_lengths(tokens, pad_idx):
+    "length of every row of a right padded N x WIDTH tensor up to its last non pad token"
+    nonpad = (tokens != pad_idx).flip(dims=[1])
+    return torch.where(nonpad.any(dim=1), tokens.size(1) - nonpad.int().argmax(dim=1), 0)
+
+def write_token_store(tensor_path, store_path, tokenizer):
+    """ Convert a split of .pt shards from 2_build_tensordataset into a flat token store for TokenStoreDataset.
+
+    selfies.bin and assay_vals.bin hold every chemical's tokens with the trailing padding removed, concatenated as int32,
+    selfies_offsets.npy and assay_val_offsets.npy the int64 start of every chemical plus the end of the last one.
+    Shards are streamed, only one is in memory at a time.
+    """
+    store_path = cvae.utils.mk_empty_directory(store_path, overwrite=True)
+    selfies_offsets, assay_val_offsets, selfies_width = [0], [0], 0
+
+    with open(store_path / "selfies.bin", "wb") as selfies_file, open(store_path / "assay_vals.bin", "wb") as assay_vals_file:
+        for file_path in tqdm.tqdm(sorted(pathlib.Path(tensor_path).glob("*.pt"))):
+            selfies, assay_vals, shard_assay_val_offsets = load_shard(file_path, tokenizer.PAD_IDX)
+            lengths = _trailing_padding_lengths(selfies, tokenizer.PAD_IDX)
+            keep = torch.arange(selfies.size(1)).unsqueeze(0) < lengths.unsqueeze(1)
+            selfies_file.write(selfies[keep].numpy().astype(np.int32).tobytes())
+            selfies_offsets.extend((selfies_offsets[-1] + torch.cumsum(lengths, dim=0)).tolist())
+            assay_vals_file.write(assay_vals.numpy().astype(np.int32).tobytes())
+            assay_val_offsets.extend((assay_val_offsets[-1] + shard_assay_val_offsets[1:]).tolist())
+            selfies_width = max(selfies_width, selfies.size(1))
+
+    np.save(store_path / "selfies_offsets.npy", np.array(selfies_offsets, dtype=np.int64))
+    np.save(store_path / "assay_val_offsets.npy", np.array(assay_val_offsets, dtype=np.int64))
+    with open(store_path / "token_store.json", "w") as file:
+        json.dump({"num_chemicals": len(selfies_offsets) - 1, "selfies_width": selfies_width, "pad_idx": tokenizer.PAD_IDX}, file)
+    return store_path
+
+class TokenStoreDataset(SequenceShiftDataset):
+    """ SequenceShiftDataset over a flat token store written by write_token_store.
+
+    The token and offset arrays are memory mapped read only, so DataLoader workers share the page cache instead of each
+    holding copies of the shards. Selfies are returned padded to the width they were stored with.
+    """
+
+    def __init__(self, path, tokenizer: SelfiesPropertyValTokenizer, nprops=5, assay_filter=[]):
+        self.path = pathlib.Path(path)
+        self.nprops = nprops
+        self.assay_filter = assay_filter
+        self.tokenizer = tokenizer
+        self.pad_idx, self.sep_idx, self.end_idx = tokenizer.PAD_IDX, tokenizer.SEP_IDX, tokenizer.END_IDX
+        with open(self.path / "token_store.json", "r") as file:
+            self.selfies_width = json.load(file)["selfies_width"]
+        self._open()
+
+    def _open(self):
+        self.selfies = np.memmap(self.path / "selfies.bin", dtype=np.int32, mode='r')
+        self.assay_vals = np.memmap(self.path / "assay_vals.bin", dtype=np.int32, mode='r')
+        self.selfies_offsets = np.load(self.path / "selfies_offsets.npy", mmap_mode='r')
+        self.assay_val_offsets = np.load(self.path / "assay_val_offsets.npy", mmap_mode='r')
+
+    def __getstate__(self):
+        # workers started with spawn reopen the maps instead of receiving pickled copies of the arrays
+        return {k: v for k, v in self.__dict__.items() if k not in ('selfies', 'assay_vals', 'selfies_offsets', 'assay_val_offsets')}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return len(self.selfies_offsets) - 1
+
+    def _raw_batch(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        assay_val_lengths = self.assay_val_offsets[indices + 1] - self.assay_val_offsets[indices]
+        selfies = _gather_rows(self.selfies, self.selfies_offsets, indices, self.selfies_width, self.pad_idx)
+        assay_vals = _gather_rows(self.assay_vals, self.assay_val_offsets, indices, int(assay_val_lengths.max(initial=0)), self.pad_idx)
+        return selfies, assay_vals
+
+    def __getitem__(self, idx):
+        return tuple(tokens[0] for tokens in self._shift_batch(*self._raw_batch([idx])))
+
+    def sample_lengths(self):
+        return np.diff(self.selfies_offsets), ((np.diff(self.assay_val_offsets) - 2) // 2).clip(min=0)
+
+class ShardStreamDataset(torch.utils.data.IterableDataset):
+    """ Streams the .pt shards of a split from 2_build_tensordataset instead of loading them all up front.
+
+    Shards are shuffled per epoch with a seed shared by every process and dealt round robin to the DDP ranks and
+    DataLoader workers, remainder shards are dropped so all of them read the same number of shards. A background thread
+    loads up to read_ahead shards ahead of the one being consumed, rows go through a shuffle buffer of buffer_size chemicals.
+
+    With batch_size set whole batches are built with SequenceShiftDataset's batched ops, use it with
+    DataLoader(ds, batch_size=None, num_workers=num_workers, collate_fn=ds.collate). Shards differ in size, so every worker
+    of every rank yields the number of full batches the smallest of them can build and all ranks stop at the same step.
+    Like BucketBatchSampler it has a seed, set_epoch and set_start and seeds every batch from (seed, epoch, rank, position),
+    so ResumableLoader can resume it mid epoch. The rows before the start are still read and drawn, but not batched.
+    """
+
+    def __init__(self, path, tokenizer: SelfiesPropertyValTokenizer, nprops=5, batch_size=None, buffer_size=10000,
+                 read_ahead=2, seed=0, num_workers=0, rank=None, world_size=None):
+        self.shards = sorted(pathlib.Path(path).glob("*.pt"))
+        self.nprops = nprops
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.read_ahead = read_ahead
+        self.seed = seed
+        # the DataLoader's num_workers, the batch budget and __len__ are computed before the workers start
+        self.num_workers = num_workers
+        self.rank, self.world_size = rank, world_size
+        self.epoch, self.start = 0, 0
+        self.tokenizer = tokenizer
+        self.pad_idx, self.sep_idx, self.end_idx = tokenizer.PAD_IDX, tokenizer.SEP_IDX, tokenizer.END_IDX
+        self._shard_rows = None
+
+    raw = False
+    set_raw = SequenceShiftDataset.set_raw
+    _shift_batch = SequenceShiftDataset._shift_batch
+    collate = SequenceShiftDataset.collate
+
+    def set_epoch(self, epoch):
+        "changes the shard order and shuffle buffer draws, call before each epoch like DistributedSampler.set_epoch"
+        self.epoch = epoch
+
+    def set_start(self, start):
+        "the next iteration begins at batch start of this rank's epoch"
+        self.start = start
+
+    def _ranks(self):
+        "(rank, world_size) of this process"
+        if self.rank is not None:
+            return self.rank, self.world_size
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        return (torch.distributed.get_rank(), torch.distributed.get_world_size()) if distributed else (0, 1)
+
+    def _worker(self):
+        """ the worker whose rows and batches this DataLoader worker produces. DataLoader always asks worker 0 first, so
+        after a resume at start the workers are rotated to keep yielding the batches in their original order """
+        num_workers = max(self.num_workers, 1)
+        worker = torch.utils.data.get_worker_info()
+        worker_id = worker.id if worker is not None else 0
+        if (worker.num_workers if worker is not None else 1) != num_workers:
+            raise ValueError(f"the dataset was built for {num_workers} DataLoader workers, the DataLoader has {worker.num_workers if worker is not None else 0}")
+        return (worker_id + self.start) % num_workers, num_workers
+
+    def _partition(self):
+        "(process index, number of processes) of this worker over ranks and workers"
+        rank, world_size = self._ranks()
+        worker_id, num_workers = self._worker()
+        return rank * num_workers + worker_id, world_size * num_workers
+
+    def _shard_order(self, num_processes):
+        order = torch.randperm(len(self.shards), generator=torch.Generator().manual_seed(self.seed + self.epoch)).tolist()
+        if len(order) < num_processes:
+            # a rank without shards would stop at its first step and leave the others waiting in all-reduce
+            raise ValueError(f"{len(order)} shards can't be split over {num_processes} ranks and workers, "
+                             "write more shards or use fewer DataLoader workers")
+        return order[:len(order) - len(order) % num_processes]
+
+    def _shard_paths(self):
+        process, num_processes = self._partition()
+        return [self.shards[i] for i in self._shard_order(num_processes)[process::num_processes]]
+
+    def _worker_batches(self):
+        """ full batches every worker of every rank yields this epoch, the fewest any of them can build. computed the
+        same way in every process from the shard sizes, which are read once from the memory mapped shards """
+        if self._shard_rows is None:
+            self._shard_rows = [torch.load(path, mmap=True)['selfies'].size(0) for path in self.shards]
+        num_processes = self._ranks()[1] * max(self.num_workers, 1)
+        order = self._shard_order(num_processes)
+        return min(sum(self._shard_rows[i] for i in order[process::num_processes]) // self.batch_size for process in range(num_processes))
+
+    def __len__(self):
+        "batches per rank and epoch"
+        return self._worker_batches() * max(self.num_workers, 1)
+
+    def _load(self, path):
+        selfies, assay_vals, assay_val_offsets = load_shard(path, self.pad_idx)
+        return selfies.long(), assay_vals.long().split(assay_val_offsets.diff().tolist())
+
+    def _read(self, paths, shards, stop):
+        "loads paths into the shards queue until stop is set, then None, or the exception a load raised"
+        try:
+            for path in paths:
+                if stop.is_set(): return
+                self._put(shards, self._load(path), stop)
+            self._put(shards, None, stop)
+        except Exception as e:
+            self._put(shards, e, stop)
+
+    @staticmethod
+    def _put(shards, item, stop):
+        "puts item on the queue, giving up once stop is set while the queue is full"
+        while not stop.is_set():
+            try:
+                shards.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _rows(self):
+        """ rows of the shards of this process, shards are loaded read_ahead at a time by a background thread. when the
+        generator is closed early the thread is told to stop and joined after at most the shard it is loading """
+        shards, stop = queue.Queue(maxsize=max(self.read_ahead, 1)), threading.Event()
+        reader = threading.Thread(target=self._read, args=(self._shard_paths(), shards, stop), daemon=True)
+        reader.start()
+        try:
+            while True:
+                shard = shards.get()
+                if shard is None: return
+                if isinstance(shard, Exception): raise shard
+                yield from zip(*shard)
+        finally:
+            stop.set()
+            reader.join()
+
+    def _draw(self, buffer, generator):
+        "removes a random row from the buffer"
+        i = int(torch.randint(len(buffer), (1,), generator=generator))
+        buffer[i], buffer[-1] = buffer[-1], buffer[i]
+        return buffer.pop()
+
+    def _samples(self):
+        process, _ = self._partition()
+        generator = torch.Generator().manual_seed(self.seed + self.epoch * 1000003 + process)
+        buffer = []
+        for row in self._rows():
+            buffer.append(row)
+            if len(buffer) >= self.buffer_size:
+                yield self._draw(buffer, generator)
+        while buffer:
+            yield self._draw(buffer, generator)
+
+    def _batch_seed(self, position):
+        return int(np.random.SeedSequence([self.seed, self.epoch, self._ranks()[0], position]).generate_state(1)[0])
+
+    def _batch(self, rows, position):
+        selfies, assay_vals = zip(*rows)
+        assay_vals = torch.nn.utils.rnn.pad_sequence(assay_vals, batch_first=True, padding_value=self.pad_idx)
+        generator = torch.Generator().manual_seed(self._batch_seed(position))
+        return self._shift_batch(torch.stack(selfies), assay_vals, generator=generator)
+
+    def __iter__(self):
+        if self.batch_size is None:
+            for selfies_raw, raw_assay_vals in self._samples():
+                yield tuple(tokens[0] for tokens in self._shift_batch(selfies_raw.unsqueeze(0), raw_assay_vals.unsqueeze(0)))
+            return
+
+        # worker w of num_workers yields the rank's batches w, w + num_workers, ..., the DataLoader interleaves them in order
+        worker_id, num_workers = self._worker()
+        num_batches, samples = self._worker_batches(), self._samples()
+        try:
+            for batch in range(num_batches):
+                rows = list(itertools.islice(samples, self.batch_size))
+                position = batch * num_workers + worker_id
+                if position >= self.start:
+                    yield self._batch(rows, position)
+        finally:
+            samples.close()
 
 class LabelSmoothingCrossEntropySequence(nn.Module):
     def __init__(self, epsilon_ls=0.1, ignore_index=None):
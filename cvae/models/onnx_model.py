@@ -0,0 +1,45 @@
+import json, pathlib, numpy as np
+
+class OnnxModel():
+    """ Runs models exported by cvae.models.export.export_onnx in ONNX Runtime on cpu. Inputs are numpy arrays or
+    cpu tensors, selfies are padded to the exported length and logits are returned as a numpy array.
+
+    onnxruntime is imported on load, this module itself needs only numpy.
+    """
+
+    def __init__(self, sessions, selfies_length, pad_idx, tokenizer=None):
+        self.sessions = sessions # teach forcing length -> onnxruntime.InferenceSession
+        self.selfies_length = selfies_length
+        self.pad_idx = pad_idx
+        self.tokenizer = tokenizer
+
+    def __call__(self, input, teach_forcing):
+        input, teach_forcing = np.asarray(input, dtype=np.int64), np.asarray(teach_forcing, dtype=np.int64)
+        if teach_forcing.shape[1] not in self.sessions:
+            raise ValueError(f"no exported graph for teach forcing length {teach_forcing.shape[1]}")
+        if input.shape[1] > self.selfies_length:
+            raise ValueError(f"selfies length {input.shape[1]} is longer than the exported {self.selfies_length}")
+
+        input = np.pad(input, ((0, 0), (0, self.selfies_length - input.shape[1])), constant_values=self.pad_idx)
+        session = self.sessions[teach_forcing.shape[1]]
+        return session.run(['logits'], {'input': input, 'teach_forcing': teach_forcing})[0]
+
+    @staticmethod
+    def load(dirpath, num_threads=None, load_tokenizer=True):
+        import onnxruntime
+        dirpath = pathlib.Path(dirpath)
+        with open(dirpath / "manifest.json", "r") as file:
+            manifest = json.load(file)
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None: options.intra_op_num_threads = num_threads
+
+        sessions = {graph["teach_length"]: onnxruntime.InferenceSession(str(dirpath / graph["file"]), options, providers=['CPUExecutionProvider'])
+                    for graph in manifest["graphs"]}
+
+        tokenizer = None
+        if load_tokenizer:
+            from cvae.tokenizer.selfies_property_val_tokenizer import SelfiesPropertyValTokenizer
+            tokenizer = SelfiesPropertyValTokenizer.load(dirpath / "spvt_tokenizer")
+        return OnnxModel(sessions, manifest["selfies_length"], manifest["pad_idx"], tokenizer)
@@ -1,4 +1,5 @@
-import torch, json, pathlib, numpy as np
+import torch, json, pathlib, types, numpy as np
+from typing import Mapping
 from cvae.tokenizer.selfies_tokenizer import SelfiesTokenizer
 
 class SelfiesPropertyValTokenizer:
@@ -15,18 +16,61 @@ class SelfiesPropertyValTokenizer:
         self.SEP_IDX = self.selfies_offset + num_assays + num_vals
         self.END_IDX = self.selfies_offset + num_assays + num_vals + 1 
         self.vocab_size = self.selfies_offset + num_assays + num_vals + 2
+        self._lookups = {}
     
-    def value_indexes(self) -> dict:
-        "returns a dictionary from value token to its tokenizer index"
-        vals = range(self.num_vals)
-        idxs = [self.value_id_to_token_idx(x) for x in vals]
-        return {x: i for x, i in zip(vals, idxs)}
+    def _lookup(self, name, device, build):
+        "lookup structure built once per device, the tokenizer's indexes are fixed once it is built or loaded"
+        key = (name, str(device))
+        if key not in self._lookups:
+            self._lookups[key] = build() if device is None else build().to(device)
+        return self._lookups[key]
     
-    def assay_indexes(self) -> dict:
-        "returns a dictionary from assay token to its tokenizer index"
-        assays = [x for x in range(self.num_assays)]
-        idxs = [self.assay_id_to_token_idx(x) for x in assays]
-        return {f"assay_{x}": i for x, i in zip(assays, idxs)}
+    def value_indexes(self) -> Mapping:
+        "returns a read only mapping from value token to its tokenizer index"
+        def build():
+            vals = range(self.num_vals)
+            idxs = [self.value_id_to_token_idx(x) for x in vals]
+            return types.MappingProxyType({x: i for x, i in zip(vals, idxs)})
+        return self._lookup('value_indexes', None, build)
+    
+    def assay_indexes(self) -> Mapping:
+        "returns a read only mapping from assay token to its tokenizer index"
+        def build():
+            assays = [x for x in range(self.num_assays)]
+            idxs = [self.assay_id_to_token_idx(x) for x in assays]
+            return types.MappingProxyType({f"assay_{x}": i for x, i in zip(assays, idxs)})
+        return self._lookup('assay_indexes', None, build)
+    
+    def value_index_tensor(self, device='cpu'):
+        "tokenizer indexes of the value tokens in value id order, cached per device and not to be modified"
+        return self._lookup('value_index_tensor', device, lambda: torch.tensor(list(self.value_indexes().values()), dtype=torch.long))
+    
+    def assay_index_tensor(self, device='cpu'):
+        "tokenizer indexes of the assay tokens in assay id order, cached per device and not to be modified"
+        return self._lookup('assay_index_tensor', device, lambda: torch.tensor(list(self.assay_indexes().values()), dtype=torch.long))
+    
+    def _token_class(self, name, indexes, tokens):
+        def build():
+            token_class = torch.zeros(self.vocab_size, dtype=torch.bool)
+            token_class[indexes()] = True
+            return token_class
+        return self._lookup(name, tokens.device, build)[tokens]
+    
+    def is_assay(self, tokens):
+        "boolean mask of the assay tokens in a tensor of token indexes, a lookup in place of torch.isin"
+        return self._token_class('is_assay', self.assay_index_tensor, tokens)
+    
+    def is_value(self, tokens):
+        "boolean mask of the value tokens in a tensor of token indexes, a lookup in place of torch.isin"
+        return self._token_class('is_value', self.value_index_tensor, tokens)
+    
+    def value_labels(self, tokens):
+        "value id, the binary label, of every value token in a tensor of token indexes and -1 for every other token"
+        def build():
+            labels = torch.full((self.vocab_size,), -1, dtype=torch.long)
+            labels[self.value_index_tensor()] = torch.arange(self.num_vals)
+            return labels
+        return self._lookup('value_labels', tokens.device, build)[tokens]
     
     def assay_id_to_token_idx(self, assay_id):
         return self.selfies_offset + assay_id
@@ -101,5 +145,6 @@ class SelfiesPropertyValTokenizer:
         tokenizer.selfies_offset = data['selfies_offset']
         tokenizer.SEP_IDX = data['SEP_IDX']
         tokenizer.END_IDX = data['END_IDX']
+        tokenizer._lookups = {}
 
         return tokenizer
\ No newline at end of file
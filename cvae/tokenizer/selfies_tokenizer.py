@@ -1,6 +1,7 @@
-import json
+import json, re, itertools, multiprocessing
+import numpy as np, pandas as pd
 import selfies as sf
-from pyspark.sql.types import BooleanType, ArrayType, IntegerType, FloatType, StringType
+from pyspark.sql.types import BooleanType, ArrayType, IntegerType, FloatType, StringType, StructType, StructField
 import pyspark.sql.functions as F
 
 class SelfiesTokenizer:
@@ -9,24 +10,48 @@ class SelfiesTokenizer:
     SOS_TOKEN = '<sos>'
     END_TOKEN = '<eos>'
     
-    def __init__(self):
+    # the symbols sf.split_selfies yields, bracketed symbols and the '.' separating fragments
+    SYMBOL_PATTERN = re.compile(r"\[[^\]]*\]|\.")
+    
+    def __init__(self, pad_length=120):
+        # selfies are encoded to pad_length tokens by transform, longer molecules are truncated
+        self.pad_length = pad_length
         # Initialize with special tokens
         self.special_tokens = [SelfiesTokenizer.PAD_TOKEN, SelfiesTokenizer.SOS_TOKEN, SelfiesTokenizer.END_TOKEN]
         self.symbol_to_index = {token: i for i, token in enumerate(self.special_tokens)}
         self.index_to_symbol = {i: token for i, token in enumerate(self.special_tokens)}
+        self._decode_table = None
+
+    def fit(self, dataset, column=None, processes=None, chunk_size=100_000):
+        """ add every symbol of the selfies in dataset to the vocabulary, new symbols are indexed in sorted order.
 
-    def fit(self, dataset, column):
-        # Extract unique symbols from the dataset in a distributed manner
-        unique_symbols_rdd = dataset.select(column).rdd \
-            .flatMap(lambda row: sf.split_selfies(row[column]) if row[column] is not None else []) \
-            .distinct()
-
-        # Collect unique symbols to the driver and merge with existing mappings
-        unique_symbols = unique_symbols_rdd.collect()
-        start_idx = len(self.symbol_to_index)  # Start indexing after special tokens
-        new_mappings = {symbol: idx + start_idx for idx, symbol in enumerate(unique_symbols) if symbol not in self.symbol_to_index}
-        self.symbol_to_index.update(new_mappings)
+        dataset is a Spark DataFrame, a pyarrow Table or an iterable of selfies strings, column names the selfies column of
+        the first two. Symbol sets are built per Spark partition, or per chunk of chunk_size selfies in a multiprocessing
+        pool of processes workers, and merged, so only the distinct symbols of each partition leave it.
+        """
+        if hasattr(dataset, 'rdd'):
+            unique_symbols = dataset.select(column).rdd \
+                .mapPartitions(lambda rows: [_symbols(row[0] for row in rows)]) \
+                .treeReduce(set.union)
+        else:
+            if hasattr(dataset, 'column'):
+                chunks = (chunk.to_pylist() for chunk in dataset.column(column).chunks)
+            else:
+                dataset = iter(dataset)
+                chunks = iter(lambda: list(itertools.islice(dataset, chunk_size)), [])
+            
+            if processes == 1:
+                unique_symbols = set().union(*map(_symbols, chunks))
+            else:
+                with multiprocessing.Pool(processes) as pool:
+                    unique_symbols = set().union(*pool.imap_unordered(_symbols, chunks))
+
+        # Merge with existing mappings, indexing after the special tokens and symbols already known
+        new_symbols = sorted(unique_symbols - self.symbol_to_index.keys())
+        start_idx = len(self.symbol_to_index)
+        self.symbol_to_index.update({symbol: idx + start_idx for idx, symbol in enumerate(new_symbols)})
         self.index_to_symbol = {idx: symbol for symbol, idx in self.symbol_to_index.items()}
+        self._decode_table = None
 
         return self
 
@@ -35,21 +60,82 @@ class SelfiesTokenizer:
         indices = [self.symbol_to_index.get(symbol, self.symbol_to_index[self.PAD_TOKEN]) for symbol in symbols]
         return indices
             
-    def transform(self, dataset, selfies_column, new_column, pad_length=120):
-        # Function to convert selfies string to indices and pad
-        def selfies_to_indices(selfies_string):
-            if selfies_string is not None:
-                symbols = [self.SOS_TOKEN] + list(sf.split_selfies(selfies_string)) + [self.END_TOKEN]
-                indices = [self.symbol_to_index.get(symbol, self.symbol_to_index[self.PAD_TOKEN]) for symbol in symbols]
-                padded_indices = indices[:pad_length] + [self.symbol_to_index[self.PAD_TOKEN]] * max(0, pad_length - len(indices))
-                return padded_indices[:pad_length]
-            else:
-                return [self.symbol_to_index[self.PAD_TOKEN]] * pad_length
+    def batch_encode(self, selfies, pad_length=None, return_lengths=False):
+        """ encode a list of selfies strings into an N x pad_length int32 array of [sos, symbols..., eos, pad...] indices
+        the way transform does, longer molecules are truncated, unknown symbols and None rows are padding. 
+        return_lengths also returns each molecule's untruncated token count including sos and eos, 0 for None rows """
+        pad_length = self.pad_length if pad_length is None else pad_length
+        lookup, pad_idx = self.symbol_to_index.get, self.symbol_to_index[self.PAD_TOKEN]
+        sos_idx, end_idx = self.symbol_to_index[self.SOS_TOKEN], self.symbol_to_index[self.END_TOKEN]
 
-        selfies_to_indices_udf = F.udf(selfies_to_indices, ArrayType(IntegerType()))
+        flat, lengths = [], np.zeros(len(selfies), dtype=np.int64)
+        for i, selfies_string in enumerate(selfies):
+            if selfies_string is None: continue
+            indices = [sos_idx] + [lookup(symbol, pad_idx) for symbol in self.SYMBOL_PATTERN.findall(selfies_string)] + [end_idx]
+            flat.extend(indices[:pad_length])
+            lengths[i] = len(indices)
 
-        # Apply the function to the dataset
-        return dataset.withColumn(new_column, selfies_to_indices_udf(F.col(selfies_column)))
+        encoded = np.full((len(selfies), pad_length), pad_idx, dtype=np.int32)
+        encoded[np.arange(pad_length) < np.minimum(lengths, pad_length)[:, None]] = flat
+        return (encoded, lengths) if return_lengths else encoded
+
+    def batch_decode(self, indexes):
+        "selfies strings of an N x L array of indices, special tokens are dropped"
+        table = self._symbol_table()
+        return [''.join(row) for row in table[np.asarray(indexes)]]
+
+    def _symbol_table(self):
+        "numpy array mapping every index to its symbol, special tokens map to empty strings"
+        if self._decode_table is None or len(self._decode_table) != max(self.index_to_symbol) + 1:
+            self._decode_table = np.full(max(self.index_to_symbol) + 1, '', dtype=object)
+            for index, symbol in self.index_to_symbol.items():
+                if symbol not in self.special_tokens: self._decode_table[index] = symbol
+        return self._decode_table
+            
+    def transform(self, dataset, selfies_column, new_column, pad_length=None, length_column=None):
+        """ add new_column with the pad_length encoding of selfies_column, see batch_encode. Record batches are encoded
+        whole in an Arrow backed pandas_udf, only the vocabulary is shipped to the executors, once, as a broadcast.
+        length_column also adds the untruncated token counts from the same pass, null for null selfies, see truncation_stats """
+        pad_length = self.pad_length if pad_length is None else pad_length
+        vocabulary = dataset.sparkSession.sparkContext.broadcast(self.symbol_to_index)
+
+        def encode(selfies):
+            tokenizer = SelfiesTokenizer(pad_length=pad_length)
+            tokenizer.symbol_to_index = vocabulary.value
+            selfies = selfies.astype(object).where(selfies.notna(), None) # arrow nulls can arrive as NaN
+            encoded, lengths = tokenizer.batch_encode(selfies.tolist(), return_lengths=True)
+            return list(encoded), pd.Series(lengths, dtype='Int32').where(selfies.notna().to_numpy())
+
+        def encode_tokens(selfies: pd.Series) -> pd.Series:
+            return pd.Series(encode(selfies)[0])
+
+        def encode_tokens_and_lengths(selfies: pd.Series) -> pd.DataFrame:
+            encoded, lengths = encode(selfies)
+            return pd.DataFrame({'encoded': encoded, 'length': lengths})
+
+        if length_column is None:
+            encode_udf = F.pandas_udf(encode_tokens, ArrayType(IntegerType()))
+            return dataset.withColumn(new_column, encode_udf(F.col(selfies_column)))
+        
+        encode_udf = F.pandas_udf(encode_tokens_and_lengths, StructType([StructField('encoded', ArrayType(IntegerType())), StructField('length', IntegerType())]))
+        dataset = dataset.withColumn(new_column, encode_udf(F.col(selfies_column)))
+        return dataset.withColumn(length_column, F.col(f'{new_column}.length')).withColumn(new_column, F.col(f'{new_column}.encoded'))
+
+    def truncation_stats(self, dataset, length_column, pad_length=None):
+        """ token length statistics including sos/eos and how many selfies transform truncates at pad_length. 
+        length_column holds the token counts transform(..., length_column=...) adds, so no extra pass over the selfies """
+        pad_length = self.pad_length if pad_length is None else pad_length
+        lengths = dataset.select(F.col(length_column).alias('length')).filter(F.col('length').isNotNull())
+        stats = lengths.agg(
+            F.count('length').alias('molecules'),
+            F.sum((F.col('length') > pad_length).cast('int')).alias('truncated'),
+            F.max('length').alias('max_length'),
+            F.expr('percentile_approx(length, array(0.5, 0.9, 0.99, 0.999))').alias('percentiles')).first()
+        
+        molecules, truncated = stats['molecules'], stats['truncated'] or 0
+        return {'pad_length': pad_length, 'molecules': molecules, 'truncated': truncated,
+                'truncated_fraction': truncated / molecules if molecules else 0.0, 'max_length': stats['max_length'],
+                **{f'p{q}_length': v for q, v in zip(['50', '90', '99', '99.9'], stats['percentiles'] or [])}}
 
     def indexes_to_selfies(self, indexes):
         symbols = [self.index_to_symbol[i] for i in indexes]
@@ -65,17 +151,22 @@ class SelfiesTokenizer:
         with open(filepath, 'w') as file:
             json.dump({
                 'symbol_to_index': self.symbol_to_index,
-                'index_to_symbol': self.index_to_symbol
+                'index_to_symbol': self.index_to_symbol,
+                'pad_length': self.pad_length
             }, file)
         return filepath
             
     @staticmethod
     def load(filepath):
-        tokenizer = SelfiesTokenizer()
         with open(filepath, 'r') as file:
             data = json.load(file)
+            # tokenizers saved before pad_length was recorded were all transformed with 120
+            tokenizer = SelfiesTokenizer(pad_length=data.get('pad_length', 120))
             tokenizer.symbol_to_index = data['symbol_to_index']
             tokenizer.index_to_symbol = data['index_to_symbol']
             tokenizer.index_to_symbol = {int(k):v for k,v in tokenizer.index_to_symbol.items()}
         return tokenizer
-            
+
+def _symbols(selfies):
+    "distinct symbols of an iterable of selfies strings, module level so Spark and multiprocessing workers can unpickle it"
+    return {symbol for selfies_string in selfies if selfies_string is not None for symbol in SelfiesTokenizer.SYMBOL_PATTERN.findall(selfies_string)}
@@ -1,9 +1,12 @@
 from flask import Flask, request, jsonify
 import pandas as pd, numpy as np
 import cvae.models.mixture_experts as moe
+import cvae.models.multitask_transformer as mt
+import cvae.models.export as export
+import cvae.models.onnx_model as onnx_model
 import cvae.spark_helpers as H
 import torch, torch.nn
-import sqlite3
+import sqlite3, os
 import threading
 import logging
 
@@ -15,7 +18,7 @@ logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s %(levelname)s:%(message)s',
                     handlers=[logging.StreamHandler()])
 
-DEVICE = torch.device(f'cuda:0')
+DEVICE = torch.device(f'cuda:0') if torch.cuda.is_available() else torch.device('cpu')
 predict_lock = threading.Lock()
 cvaesql = sqlite3.connect('brick/cvae.sqlite')
 cvaesql.row_factory = sqlite3.Row  # This enables column access by name
@@ -51,11 +54,31 @@ class Prediction():
         
 class Predictor():
     
-    def __init__(self):
+    def __init__(self, model_path="brick/moe", compile=False, skip_threshold=None):
         self.dburl = 'brick/cvae.sqlite'
-        self.model = moe.MoE.load("brick/moe").to(DEVICE)
-        self.tokenizer = self.model.tokenizer
-        self.model = torch.nn.DataParallel(self.model)  
+        self.selfies_lengths = None
+        
+        # traced artifacts from cvae.models.export run on the device they were traced for, onnx exports in
+        # onnx runtime on cpu, otherwise any model directory saved by MoE, SharedEncoderMoE or MultitaskTransformer
+        if export.export_format(model_path) == "onnx":
+            self.model = onnx_model.OnnxModel.load(model_path)
+            self.tokenizer, self.device = self.model.tokenizer, torch.device('cpu')
+        elif export.is_traced(model_path):
+            self.model = export.TracedModel.load(model_path)
+            self.tokenizer, self.device = self.model.tokenizer, self.model.device
+        else:
+            # mixtures of experts skip the experts whose gating weight is below skip_threshold, see code/5_4_calibrate_expert_skipping.py
+            config = {} if skip_threshold is None else {"skip_threshold": skip_threshold}
+            self.model = moe.load_model(model_path, **config).to(DEVICE)
+            self.tokenizer, self.device = self.model.tokenizer, DEVICE
+            self.model = torch.compile(self.model, dynamic=False) if compile else torch.nn.DataParallel(self.model)
+            # a static shape graph is compiled for every selfies length it sees, so compiled models get their inputs
+            # padded up to the export bucket lengths and a handful of graphs serve every molecule
+            self.selfies_lengths = sorted({shape[1] for shape in export.DEFAULT_BUCKETS}) if compile else None
+        
+        # value token indexes on the model's device and the position of the positive value among them
+        self.value_indexes = self.tokenizer.value_index_tensor(self.device)
+        self.one_index = list(self.tokenizer.value_indexes()).index(1)
         
         conn = sqlite3.connect(self.dburl)
         conn.row_factory = sqlite3.Row 
@@ -116,8 +139,13 @@ class Predictor():
         
         smiles = H.inchi_to_smiles_safe(inchi)
         selfies = H.smiles_to_selfies_safe(smiles)
-        input = torch.LongTensor(self.tokenizer.selfies_tokenizer.selfies_to_indices(selfies))
-        input = input.view(1, -1).to(DEVICE)
+        # trailing padding is dropped so traced models pick their narrowest bucket and eager models skip the pad positions
+        input = torch.from_numpy(self.tokenizer.selfies_tokenizer.batch_encode([selfies])).long()
+        input = mt.trim_padding(input, self.tokenizer.PAD_IDX)
+        if self.selfies_lengths is not None:
+            length = min((length for length in self.selfies_lengths if length >= input.size(1)), default=input.size(1))
+            input = torch.nn.functional.pad(input, (0, length - input.size(1)), value=self.tokenizer.PAD_IDX)
+        input = input.to(self.device)
         # moe takes as input selfies_token and pv_token as teach_force output
         
         # known_props = pd.DataFrame(self._get_known_properties(inchi))
@@ -154,12 +182,12 @@ class Predictor():
         # print(f"Stacked Random Tensors size: {rand_tensors.size()}")
         
         # out = torch.hstack([av_truncate,torch.tensor([self.pad_idx])])
-        teach_force = torch.LongTensor([1, self.tokenizer.SEP_IDX, property_token]).view(1, -1).to(DEVICE)
+        teach_force = torch.LongTensor([1, self.tokenizer.SEP_IDX, property_token]).view(1, -1).to(self.device)
 
         # Ensure indices are within bounds
         try:
-            value_indexes = list(self.tokenizer.value_indexes().values())
-            result_logit = self.model(input, teach_force)[:, -1, value_indexes]
+            with torch.no_grad():
+                result_logit = torch.as_tensor(self.model(input, teach_force), device=self.device)[:, -1, self.value_indexes]
         except RuntimeError as e:
             print(f"Error in model forward pass: {e}")
             print(f"selfies shape: {input.shape}, teach_force shape: {teach_force.shape}")
@@ -168,15 +196,13 @@ class Predictor():
         return torch.softmax(result_logit, dim=1).detach().cpu().numpy()
     
     def predict_property(self, inchi, property_token, seed=137) -> dict:
-        value_indexes = list(self.tokenizer.value_indexes().values())
-        one_index = value_indexes.index(self.tokenizer.value_id_to_token_idx(1))
         predictions = self.predict_property_with_randomized_tensors(inchi, property_token, seed)
         
         if predictions.size == 0:
             logging.info(f"No predictions generated for InChI: {inchi} and property token: {property_token}")
             return np.nan  # or handle this case appropriately
         
-        return np.mean(predictions[:, one_index], axis=0)
+        return np.mean(predictions[:, self.one_index], axis=0)
     
     def cached_predict_property(self, inchi, property_token):
         prediction = Prediction.get(inchi, property_token)
@@ -188,7 +214,8 @@ class Predictor():
         return prediction
 
 app = Flask(__name__)
-predictor = Predictor()
+skip_threshold = float(os.environ["CVAE_SKIP_THRESHOLD"]) if "CVAE_SKIP_THRESHOLD" in os.environ else None
+predictor = Predictor(os.environ.get("CVAE_MODEL_PATH", "brick/moe"), compile=os.environ.get("CVAE_TORCH_COMPILE") == "1", skip_threshold=skip_threshold)
 # InChI=1S/C9H8O4/c1-6(10)13-8-5-3-2-4-7(8)9(11)12/h2-5H,1H3,(H,11,12) and property token: 6178
 inchi = "InChI=1S/C9H8O4/c1-6(10)13-8-5-3-2-4-7(8)9(11)12/h2-5H,1H3,(H,11,12)"
 property_token = 6178